@@ -0,0 +1,119 @@
+# batch.py
+#
+# headless pre-analysis of every position of every game in a pgn
+#   python batch.py games.pgn [--engines N] [--time SECONDS] [--out FILE]
+# scores go to <pgn>.evals, positions already in the store are skipped so an interrupted run resumes
+
+import sys
+import time
+import argparse
+
+from collections import deque
+
+import chess
+import chess.engine
+import chess.pgn
+import chess.polyglot
+
+from enginepool import EnginePool
+from scheduler import EngineScheduler
+from evaluation import moves_score
+from evalstore import EvalStore, STORE_SUFFIX
+
+# progress line every so many seconds
+REPORT_INTERVAL = 5
+
+def game_positions(game):
+    # (key, board) before every mainline move
+    board = game.board()
+    for move in game.mainline_moves():
+        yield chess.polyglot.zobrist_hash(board), board.copy(stack=False)
+        board.push(move)
+
+class BatchAnalysis:
+    def __init__(self, pgn_name, store_name, engines=2, limit=chess.engine.Limit(time=0.1), command='stockfish'):
+        self.pgn_name = pgn_name
+        self.limit = limit
+        self.store = EvalStore().open(store_name)
+        self.pool = EnginePool(command, engines)
+        self.scheduler = EngineScheduler(self.pool)
+        # outstanding requests, enough to keep every engine busy
+        self.window = deque()
+        self.window_size = engines * 4
+        self.queued = set()
+
+        self.games = 0
+        self.analyzed = 0
+        self.skipped = 0
+        self.started = time.time()
+        self.reported = self.started
+
+    def run(self):
+        try:
+            with open(self.pgn_name) as pgn_file:
+                while True:
+                    game = chess.pgn.read_game(pgn_file)
+                    if game is None:
+                        break
+                    self.games += 1
+                    for key, board in game_positions(game):
+                        self.submit(key, board)
+                    self.store.flush()
+            while self.window:
+                self.collect()
+        finally:
+            self.scheduler.close()
+            self.pool.close()
+            self.store.close()
+        self.report(True)
+
+    def submit(self, key, board):
+        if key in self.store or key in self.queued:
+            self.skipped += 1
+            return
+        moves = list(board.legal_moves)
+        if not moves:
+            return
+        while len(self.window) >= self.window_size:
+            self.collect()
+        # score every legal move so any user move can be looked up later
+        future = self.scheduler.submit(board, self.limit, multipv=len(moves))
+        self.window.append((key, future))
+        self.queued.add(key)
+
+    def collect(self):
+        key, future = self.window.popleft()
+        self.queued.discard(key)
+        try:
+            info = future.result()
+        except Exception as e:
+            print('[BATCH] analysis failed:', e)
+            return
+        depth = min((line.get('depth', 0) for line in info), default=0)
+        self.store.add(key, depth, moves_score(info))
+        self.analyzed += 1
+        self.report()
+
+    def report(self, final=False):
+        now = time.time()
+        if not final and now - self.reported < REPORT_INTERVAL:
+            return
+        self.reported = now
+        elapsed = max(now - self.started, 1e-9)
+        print('[BATCH] %d games, %d positions analyzed, %d skipped, %.1f positions/s' %
+              (self.games, self.analyzed, self.skipped, self.analyzed / elapsed))
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Pre-analyze every position of a pgn database')
+    parser.add_argument('pgn')
+    parser.add_argument('--out', help='eval store file (default <pgn>' + STORE_SUFFIX + ')')
+    parser.add_argument('--engines', type=int, default=2, help='number of engine processes')
+    parser.add_argument('--time', type=float, default=0.1, help='seconds per position')
+    parser.add_argument('--engine', default='stockfish', help='uci engine command')
+    args = parser.parse_args(argv)
+
+    store_name = args.out if args.out else args.pgn + STORE_SUFFIX
+    BatchAnalysis(args.pgn, store_name, args.engines, chess.engine.Limit(time=args.time), args.engine).run()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
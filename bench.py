@@ -0,0 +1,280 @@
+# bench.py
+#
+# benchmarks of the coaching hot paths over the bundled data, run headless
+#   python bench.py [--only NAME ...] [--repeat 5] [--out bench.json] [--baseline bench_baseline.json] [--save-baseline]
+# every benchmark times a fixed piece of work, so lower is better; results are compared with a saved baseline
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import platform
+import tempfile
+import threading
+
+import chess
+import chess.pgn
+import chess.polyglot
+
+from pgnindex import PgnIndex
+from headerstore import HeaderStore
+from openingdb import OpeningDB, build as build_openings
+from book import Book
+
+BENCH_VERSION = 2
+BASELINE_FILE = 'bench_baseline.json'
+
+# slower than the baseline by more than this fraction counts as a regression
+TOLERANCE = 0.10
+
+# games of games.pgn whose positions are probed and painted
+PROBE_GAMES = 50
+
+# simulated clients, plies per game and the seed of their random moves for the message benchmark
+MESSAGE_CLIENTS = 50
+MESSAGE_MOVES = 40
+SEED = 1
+
+def game_positions(pgn_name, count):
+    # (key, board, move) before every mainline move of the first count games
+    positions = []
+    with open(pgn_name) as pgn_file:
+        for i in range(count):
+            game = chess.pgn.read_game(pgn_file)
+            if game is None:
+                break
+            board = game.board()
+            for move in game.mainline_moves():
+                positions.append((chess.polyglot.zobrist_hash(board), board.copy(stack=False), move))
+                board.push(move)
+    return positions
+
+def bench_header_scan(pgn_name):
+    # the header scan behind populate_game_list_from_pgn, without the sidecar index
+    def run():
+        index = PgnIndex(pgn_name)
+        index.scan(0)
+        return {'games': len(index)}
+    return run
+
+def bench_header_query():
+    store = HeaderStore(PgnIndex('games.pgn').load())
+    queries = ['carlsen', 'elo:2700-', 'eco:B20-B99', 'result:1-0 sort:-date', 'sort:white']
+    def run():
+        for text in queries:
+            store.query(text)
+        return {'queries': len(queries)}
+    return run
+
+def bench_opening_init():
+    # compiling ecoe.pgn, what init_openings does when ecoe.bin is out of date
+    db_name = os.path.join(tempfile.mkdtemp(), 'ecoe.bin')
+    def run():
+        lines, keys = build_openings('ecoe.pgn', db_name)
+        return {'lines': lines, 'positions': keys}
+    return run
+
+def bench_opening_lookup(positions):
+    openings = OpeningDB('ecoe.pgn').load()
+    def run():
+        # as get_opening_name, hashing included
+        named = sum(1 for key, board, move in positions if openings.name(chess.polyglot.zobrist_hash(board)))
+        return {'lookups': len(positions), 'named': named}
+    return run
+
+def bench_book_probe(positions, cached):
+    # is_book_move over every probed move, with a fresh book or one whose cache is warm
+    warm = Book(['book.bin'])
+    def run():
+        book = warm if cached else Book(['book.bin'])
+        found = sum(1 for key, board, move in positions if book.is_book_move(board, move))
+        if not cached:
+            book.close()
+        return {'probes': len(positions), 'book_moves': found}
+    return run
+
+def bench_paint(positions, changing):
+    # QBoard.paintEvent on the offscreen platform, same position or a new one every paint
+    # the widget is shown, a hidden one is resized by every grab() and loses its cached layer
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    from PyQt5.QtWidgets import QApplication
+    from qboard import QBoard
+
+    app = QApplication.instance() or QApplication([])
+
+    class Game:
+        can_move = False
+
+        def get_last_move(self):
+            return None
+
+    widget = QBoard(Game())
+    widget.resize(640, 640)
+    boards = [board for key, board, move in positions[:100]]
+    widget.setBoard(boards[0])
+    widget.show()
+    app.processEvents()
+
+    # counts the board layers built, once per position
+    layers = []
+    paint_layer = widget.paint_layer
+    def counted(*args):
+        layers.append(1)
+        return paint_layer(*args)
+    widget.paint_layer = counted
+
+    widget.repaint()
+    def run():
+        del layers[:]
+        for i, board in enumerate(boards):
+            if changing:
+                widget.setBoard(board)
+            widget.repaint()
+        app.processEvents()
+        expected = len(boards) if changing else 0
+        if len(layers) > expected:
+            raise RuntimeError('board layer built %d times, at most %d expected' % (len(layers), expected))
+        return {'paints': len(boards), 'layers': len(layers)}
+    run.keep = (app, widget)
+    return run
+
+def bench_messages():
+    # challenge games relayed between simulated clients by a server on localhost
+    from server import Server
+    from loadgen import simulate, percentile
+
+    def run():
+        server = Server('localhost', 0, verbose=False)
+        ok, msg = server.connect()
+        if not ok:
+            raise OSError(msg)
+        port = server.socket.getsockname()[1]
+        thread = threading.Thread(target=server.listen, daemon=True)
+        thread.start()
+        while server.loop is None:
+            time.sleep(0.01)
+        random.seed(SEED)
+        stats, elapsed = asyncio.run(simulate('localhost', port, MESSAGE_CLIENTS, MESSAGE_MOVES))
+        server.stop()
+        thread.join()
+        return {'moves': stats.moves, 'moves_per_s': round(stats.moves / max(elapsed, 1e-9)),
+                'p50_ms': round(percentile(stats.latencies, 0.5) * 1000, 3),
+                'p95_ms': round(percentile(stats.latencies, 0.95) * 1000, 3)}
+    return run
+
+def benchmarks():
+    # name -> setup returning the timed function; setups run once and are not timed
+    positions = lambda: game_positions('games.pgn', PROBE_GAMES)
+    return {
+        'header_scan_games': lambda: bench_header_scan('games.pgn'),
+        'header_scan_tactics': lambda: bench_header_scan('tactics.pgn'),
+        'header_query': bench_header_query,
+        'opening_init': bench_opening_init,
+        'opening_lookup': lambda: bench_opening_lookup(positions()),
+        'book_probe_cold': lambda: bench_book_probe(positions(), False),
+        'book_probe_cached': lambda: bench_book_probe(positions(), True),
+        'paint_same_position': lambda: bench_paint(positions(), False),
+        'paint_new_position': lambda: bench_paint(positions(), True),
+        'message_relay': bench_messages,
+    }
+
+def measure(run, repeat):
+    times = []
+    info = {}
+    for i in range(repeat):
+        started = time.perf_counter()
+        info = run()
+        times.append((time.perf_counter() - started) * 1000)
+    times.sort()
+    result = {'median_ms': round(times[len(times) // 2], 3), 'min_ms': round(times[0], 3), 'repeat': repeat}
+    result.update(info)
+    return result
+
+def compare(results, baseline, tolerance):
+    # prints the change of every benchmark against baseline, returns the names that regressed
+    regressed = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base or 'median_ms' not in result:
+            print('%-22s %10.3f ms   (no baseline)' % (name, result.get('median_ms', 0)))
+            continue
+        change = result['median_ms'] / base['median_ms'] - 1 if base['median_ms'] else 0
+        flag = ''
+        if change > tolerance:
+            flag = 'REGRESSION'
+            regressed.append(name)
+        elif change < -tolerance:
+            flag = 'faster'
+        print('%-22s %10.3f ms  baseline %10.3f ms  %+6.1f%%  %s' % (name, result['median_ms'], base['median_ms'], change * 100, flag))
+    return regressed
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark the coaching hot paths')
+    parser.add_argument('--only', nargs='*', help='benchmarks to run (default: all)')
+    parser.add_argument('--repeat', type=int, default=5, help='timed runs per benchmark, the median is kept')
+    parser.add_argument('--out', help='write the results to this json file')
+    parser.add_argument('--baseline', default=BASELINE_FILE, help='baseline json to compare with')
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE, help='slowdown counted as a regression')
+    args = parser.parse_args(argv)
+
+    available = benchmarks()
+    names = args.only if args.only else list(available)
+    unknown = [name for name in names if name not in available]
+    if unknown:
+        print('unknown benchmarks:', ', '.join(unknown), '- available:', ', '.join(available))
+        return 2
+
+    results = {}
+    failed = []
+    for name in names:
+        try:
+            run = available[name]()
+            run()
+            results[name] = measure(run, args.repeat)
+        except ImportError as e:
+            # e.g. no PyQt5 on a headless build machine
+            print('[BENCH] skipped', name + ':', e)
+            results[name] = {'skipped': str(e)}
+            continue
+        except RuntimeError as e:
+            # the benchmark no longer measures what it should
+            print('[BENCH] failed', name + ':', e)
+            results[name] = {'failed': str(e)}
+            failed.append(name)
+            continue
+        print('[BENCH] %-22s %10.3f ms' % (name, results[name]['median_ms']))
+
+    report = {
+        'version': BENCH_VERSION,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'chess': chess.__version__,
+        'platform': platform.platform(),
+        'results': results,
+    }
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=1)
+
+    regressed = []
+    try:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    except (OSError, ValueError):
+        baseline = None
+    if baseline and baseline.get('version') == BENCH_VERSION and not args.save_baseline:
+        print()
+        regressed = compare(results, baseline['results'], args.tolerance)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=1)
+        print('[BENCH] baseline saved to', args.baseline)
+    return 1 if regressed or failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,146 @@
+# book.py
+#
+# polyglot opening books, memory-mapped and binary searched in place
+# several books can be open at once, their moves merged with a weight per book
+
+import mmap
+import struct
+import threading
+
+from collections import OrderedDict
+
+import chess
+import chess.polyglot
+
+import instrument
+
+# key, raw move, weight, learn, big-endian as in the polyglot format
+ENTRY = struct.Struct('>QHHI')
+KEY = struct.Struct('>Q')
+
+# positions whose merged moves are kept in memory
+BOOK_CACHE_SIZE = 4096
+
+def decode_move(board, raw_move):
+    # polyglot move to a chess.Move on board, castling is stored as king takes rook
+    to_square = raw_move & 0x3f
+    from_square = (raw_move >> 6) & 0x3f
+    promotion = (raw_move >> 12) & 0x7
+    return board._from_chess960(board.chess960, from_square, to_square, promotion + 1 if promotion else None)
+
+class BookFile:
+    def __init__(self, file_name, weight=1):
+        self.file_name = file_name
+        self.weight = weight
+        self.file = open(file_name, 'rb')
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty book
+            self.map = b''
+        if len(self.map) % ENTRY.size:
+            self.close()
+            raise OSError('not a polyglot book: ' + file_name)
+        self.count = len(self.map) // ENTRY.size
+
+    def __len__(self):
+        return self.count
+
+    def find(self, key):
+        # [(raw move, weight)] of the entries of key, binary searched over the mapped file
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if KEY.unpack_from(self.map, mid * ENTRY.size)[0] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        entries = []
+        while lo < self.count:
+            entry_key, raw_move, weight, _ = ENTRY.unpack_from(self.map, lo * ENTRY.size)
+            if entry_key != key:
+                break
+            entries.append((raw_move, weight))
+            lo += 1
+        return entries
+
+    def close(self):
+        if isinstance(self.map, mmap.mmap):
+            self.map.close()
+        self.map = b''
+        self.count = 0
+        self.file.close()
+
+# the open books with an lru cache of the merged moves of each position
+class Book:
+    def __init__(self, file_names=(), cache_size=BOOK_CACHE_SIZE):
+        self.books = []
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        for file_name in file_names:
+            self.add(file_name)
+
+    def __len__(self):
+        return len(self.books)
+
+    def add(self, file_name, weight=1):
+        # open another book, the weights of its entries are scaled by weight when merged
+        self.books.append(BookFile(file_name, weight))
+        self.clear()
+        return self
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+
+    @instrument.timed('book.probe')
+    def find_all(self, board, key=None):
+        # [chess.polyglot.Entry] of the legal book moves, merged weights, heaviest first
+        # pass key when the zobrist hash of board is already known
+        if key is None:
+            key = chess.polyglot.zobrist_hash(board)
+        with self.lock:
+            entries = self.cache.get(key)
+            if entries is not None:
+                self.cache.move_to_end(key)
+                self.hits += 1
+                return entries
+
+        merged = {}
+        for book in self.books:
+            for raw_move, weight in book.find(key):
+                move = decode_move(board, raw_move)
+                entry = merged.get(move)
+                merged[move] = (raw_move, (entry[1] if entry else 0) + weight * book.weight)
+        entries = [chess.polyglot.Entry(key, raw_move, weight, 0, move)
+                   for move, (raw_move, weight) in merged.items() if weight > 0 and board.is_legal(move)]
+        entries.sort(key=lambda entry: -entry.weight)
+
+        with self.lock:
+            self.misses += 1
+            self.cache[key] = entries
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return entries
+
+    def is_book_move(self, board, move, key=None):
+        return any(move == entry.move for entry in self.find_all(board, key))
+
+    def game_moves(self, board, moves):
+        # book flag of every move of a game from board, one hash per position
+        # the positions stay cached for the lookups made while the game is played
+        board = board.copy(stack=False)
+        flags = []
+        for move in moves:
+            flags.append(self.is_book_move(board, move))
+            board.push(move)
+        return flags
+
+    def close(self):
+        for book in self.books:
+            book.close()
+        self.books = []
+        self.clear()
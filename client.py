@@ -1,8 +1,68 @@
 # client.py
 
 import socket
+import itertools
+import threading
 from _thread import *
 
+from concurrent.futures import Future
+
+from protocol import PROTOCOL_VERSION, ProtocolError, FrameDecoder, encode, decode_line
+from scheduler import BACKGROUND
+
+# seconds a request may wait beyond its search time before it fails over to the local engines
+REMOTE_GRACE = 10
+
+class RemoteAnalysisError(Exception):
+    pass
+
+# engine requests answered by the server's shared engines, submit() works like EngineScheduler.submit()
+class RemoteScheduler:
+    def __init__(self, client):
+        self.client = client
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+
+    def submit(self, board, limit, priority=BACKGROUND, multipv=None, root_moves=None):
+        future = Future()
+        request_id = str(next(self.ids))
+        seconds = limit.time if limit.time is not None else 1
+        # a server that stays connected but never answers fails the request at its deadline
+        deadline = threading.Timer(seconds + REMOTE_GRACE, self.resolve, (request_id, [], 'the server did not answer in time'))
+        deadline.daemon = True
+        with self.lock:
+            self.pending[request_id] = (future, board.turn, multipv, deadline)
+        deadline.start()
+        if not self.client.send('ANALYZE', request_id, board.fen(), seconds, priority, multipv or '',
+                                *[m.uci() for m in root_moves or ()]):
+            self.resolve(request_id, [])
+        return future
+
+    def resolve(self, request_id, fields, error='the server could not analyse the position'):
+        with self.lock:
+            request = self.pending.pop(request_id, None)
+        if request is None:
+            return
+        future, turn, multipv, deadline = request
+        deadline.cancel()
+        try:
+            lines = [decode_line(field, turn) for field in fields]
+        except ProtocolError as e:
+            future.set_exception(RemoteAnalysisError(str(e)))
+            return
+        if not lines:
+            future.set_exception(RemoteAnalysisError(error))
+        else:
+            future.set_result(lines[0] if multipv is None else lines)
+
+    def close(self):
+        # fail whatever is still waiting for an answer
+        with self.lock:
+            request_ids = list(self.pending)
+        for request_id in request_ids:
+            self.resolve(request_id, [])
+
 class Client:
     def __init__(self, ip, port, username, tab):
         self.username = username
@@ -12,10 +72,23 @@ class Client:
         self.addr = (ip, port)
         
         self.connected = False
+        # set by the first user list, a join the server refuses ends with an error instead
+        self.joined = False
+        self.join_error = None
+        # sequence number of the last presence update applied
+        self.presence_seq = None
+        # set once the server says it offers shared analysis
+        self.scheduler = None
         self.client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.connect()
+        # moves are tiny, send them right away
+        self.client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # the ui, the listener and engine callbacks all send, one frame at a time
+        self.send_lock = threading.Lock()
+        if not self.connect():
+            return
         
-        self.send('NEW|'+username)
+        self.send('HELLO', PROTOCOL_VERSION)
+        self.send('NEW', username)
         start_new_thread(self.listen, ())
         self.connected = True
             
@@ -24,38 +97,108 @@ class Client:
             self.client.connect(self.addr)
         except Exception as e:
             print(e)
+            return False
+        return True
 
     def listen(self):
+        decoder = FrameDecoder()
+        print('['+self.username+'] listening...')
         while True:
-            print('['+self.username+'] listening...')
             try:
-                ret = self.client.recv(2048)
-                if not ret:
+                data = self.client.recv(65536)
+                if not data:
                     break
-                    
-                ret = ret.decode("utf-8")
-                print('['+self.username+']<< ', ret)
-                if ret[:9]=='CONNECTED':
-                    ret = ret[9:]
-                if ret:
-                    cmd, value = ret.split('|')
-                    if cmd=='USERS':
-                        self.tab.clearUsers()
-                        for user in eval(value):
-                            self.tab.addUser(user)
+
+                for cmd, args in decoder.feed(data):
+                    print('['+self.username+']<< ', cmd, args)
+                    self.handle(cmd, args)
                 
-            except socket.error as e:
+            except (socket.error, ProtocolError) as e:
                 print(e)
                 break
+        self.connected = False
+        if self.scheduler:
+            self.scheduler.close()
+        if not self.joined:
+            self.tab.rejected.emit(self.join_error or 'the server closed the connection')
+
+    def handle(self, cmd, args):
+        if cmd=='WELCOME':
+            print('['+self.username+'] connected, protocol', args[0])
+            if len(args) > 1 and args[1] == '1':
+                self.scheduler = RemoteScheduler(self)
+        elif cmd=='RESULT':
+            if self.scheduler:
+                self.scheduler.resolve(args[0], args[1:])
+        elif cmd=='ERROR':
+            print('['+self.username+'] server error:', args[0] if args else '')
+            if not self.joined:
+                self.join_error = args[0] if args else 'refused by the server'
+        elif cmd=='SNAPSHOT':
+            self.presence_seq = int(args[0])
+            self.tab.setUsers(args[1:])
+            if not self.joined:
+                self.joined = True
+                self.tab.joined.emit()
+        elif cmd=='JOIN' or cmd=='LEAVE':
+            seq = int(args[0])
+            if self.presence_seq is None or seq <= self.presence_seq:
+                # already part of the snapshot we have or are waiting for
+                return
+            if seq != self.presence_seq + 1:
+                # missed an update, ask for the whole list again
+                self.presence_seq = None
+                self.send('RESYNC')
+                return
+            self.presence_seq = seq
+            if cmd=='JOIN':
+                self.tab.addUser(args[1])
+            else:
+                self.tab.removeUser(args[1])
+        elif cmd=='CHALLENGE':
+            self.tab.challengeReceived.emit(args[0])
+        elif cmd=='DECLINE':
+            self.tab.challengeDeclined.emit(args[0])
+        elif cmd=='START':
+            self.tab.gameStarted.emit(args[0], args[1], args[2])
+        elif cmd=='GAME':
+            self.tab.gameSnapshot.emit(args[0], args[1], args[2], args[3:])
+        elif cmd=='MOVE':
+            self.tab.gameMoved.emit(args[0], args[1])
+        elif cmd=='END':
+            self.tab.gameEnded.emit(args[0], args[1])
+
+    def challenge(self, username):
+        self.send('CHALLENGE', username)
+
+    def accept(self, username):
+        self.send('ACCEPT', username)
+
+    def decline(self, username):
+        self.send('DECLINE', username)
+
+    def watch(self, game_id):
+        self.send('WATCH', game_id)
+
+    def move(self, game_id, uci):
+        self.send('MOVE', game_id, uci)
         
-    def send(self, data):
+    def send(self, cmd, *args):
         try:
-            print('['+self.username+']>> ', data)
-            self.client.send(str.encode(data))
+            print('['+self.username+']>> ', cmd, args)
+            data = encode(cmd, *args)
+            with self.send_lock:
+                self.client.sendall(data)
+            return True
             
         except socket.error as e:
             print(e)
+            return False
             
     def stop(self):
+        try:
+            # wakes the listen thread and lets the server see us leave
+            self.client.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
         self.client.close()
-        
\ No newline at end of file
@@ -0,0 +1,124 @@
+# coach.py
+#
+# the coaching core without any gui: engines, opening names, book moves and move comparison
+# imports only python-chess and the data modules, so headless jobs and worker processes load it quickly
+#   from coach import Coach
+#   coach = Coach().load()
+#   coach.compare_move(board, user_move, game_move)
+
+import os
+
+from concurrent.futures import Future
+
+import chess
+import chess.engine
+import chess.polyglot
+
+from openingdb import OpeningDB
+from book import Book
+from enginepool import EnginePool
+from scheduler import EngineScheduler, BACKGROUND, then, fallback
+from evalcache import EvalCache
+from evalstore import EvalStore
+from evaluation import board_score, moves_score
+
+import instrument
+
+# number of stockfish processes and seconds an analysis may wait/overrun
+ENGINE_POOL_SIZE = max(1, min(4, (os.cpu_count() or 2) // 2))
+ENGINE_TIMEOUT = 10
+
+# polyglot books and the weight of their moves when merged
+BOOK_FILES = [('book.bin', 1)]
+
+# engine results kept in memory
+EVAL_CACHE_MB = 64
+
+class Coach:
+    def __init__(self, engine='stockfish', engines=ENGINE_POOL_SIZE, timeout=ENGINE_TIMEOUT,
+                 openings='ecoe.pgn', cache_mb=EVAL_CACHE_MB):
+        self.openings = OpeningDB(openings)
+        # scores pre-computed by batch.py for the loaded databases
+        self.eval_store = EvalStore()
+        # books are added by load_books, until then no move is a book move
+        self.book = Book()
+        # engines start on first use, a client of a server with shared analysis may never need them
+        self.engines = EnginePool(engine, engines, timeout, lazy=True)
+        self.eval_cache = EvalCache(cache_mb << 20)
+        self.scheduler = EngineScheduler(self.engines, timeout, self.eval_cache)
+        # clients of joined servers, asked first for analysis
+        self.remote_clients = []
+
+    def load(self, book_files=BOOK_FILES):
+        # books and opening names, for callers that do not load them in the background
+        self.load_books(book_files)
+        self.openings.load()
+        return self
+
+    def load_books(self, book_files=BOOK_FILES):
+        for file_name, weight in book_files:
+            self.book.add(file_name, weight)
+
+    # key is the zobrist hash of board when the caller already has it
+    @instrument.timed('openings.lookup')
+    def opening_name(self, board, key=None):
+        return self.openings.name(chess.polyglot.zobrist_hash(board) if key is None else key)
+
+    def is_book_move(self, board, move, key=None):
+        return self.book.is_book_move(board, move, key)
+
+    # engine requests return futures, evaluate_* block for the result
+    def engine_submit(self, board, limit, priority=BACKGROUND, multipv=None, root_moves=None):
+        # a joined server's shared engines when it offers them, the local engines if it fails
+        local = lambda: self.scheduler.submit(board, limit, priority, multipv, root_moves)
+        for client in list(self.remote_clients):
+            if client.connected and client.scheduler:
+                return fallback(client.scheduler.submit(board, limit, priority, multipv, root_moves), local)
+        return local()
+
+    def submit_board(self, board, time=1, priority=BACKGROUND):
+        future = self.engine_submit(board, chess.engine.Limit(time=time), priority)
+        return instrument.time_future('engine.board', then(future, board_score))
+
+    def submit_moves(self, board, moves_list, priority=BACKGROUND):
+        stored = self.eval_store.scores(board, moves_list)
+        if stored is not None:
+            instrument.count('engine.stored')
+            future = Future()
+            future.set_result(stored)
+            return future
+        future = self.engine_submit(board, chess.engine.Limit(time=1), priority, multipv=len(moves_list), root_moves=moves_list)
+        return instrument.time_future('engine.moves', then(future, moves_score))
+
+    def stream_board(self, board, on_info, multipv=None):
+        # infinite analysis on the local engines, see EngineScheduler.stream; end it with stop_stream
+        return self.scheduler.stream(board, on_info, multipv)
+
+    def stop_stream(self, stream):
+        self.scheduler.stop(stream)
+
+    def evaluate_board(self, board, time=1):
+        return self.submit_board(board, time).result()
+
+    def evaluate_moves(self, board, moves_list):
+        return self.submit_moves(board, moves_list).result()
+
+    def compare_move(self, board, move, game_move, is_book=None):
+        # (is book move, opening name, future of the score of move minus game_move or None)
+        # the score is only searched for a move that differs from the game and is not in the book
+        key = chess.polyglot.zobrist_hash(board)
+        if is_book is None:
+            is_book = self.is_book_move(board, move, key)
+        opening = self.opening_name(board, key) if is_book else None
+        if move == game_move or is_book:
+            return is_book, opening, None
+        future = self.submit_moves(board.copy(), [move, game_move])
+        return is_book, opening, then(future, lambda scores: scores[move] - scores[game_move])
+
+    def close(self, eval_cache_file=None):
+        self.book.close()
+        self.openings.close()
+        self.scheduler.close()
+        self.engines.close()
+        if eval_cache_file:
+            self.eval_cache.save(eval_cache_file)
@@ -0,0 +1,122 @@
+# enginepool.py
+
+import queue
+import asyncio
+import threading
+
+from contextlib import contextmanager
+
+import chess.engine
+
+class EngineTimeout(Exception):
+    pass
+
+# pool of uci engine processes, each engine is used by one caller at a time
+# a lazy pool starts its engines on first use instead of up front
+class EnginePool:
+    def __init__(self, command='stockfish', size=2, timeout=10, lazy=False):
+        self.command = command
+        self.size = size
+        self.timeout = timeout
+        # the engine checked in last is handed out first, its hash holds the lines just searched
+        self.idle = queue.LifoQueue()
+        self.engines = []
+        self.lock = threading.Lock()
+        self.closed = False
+        self.started = 0
+
+        if not lazy:
+            for i in range(size):
+                self.idle.put(self.start())
+            self.started = size
+
+    def start(self):
+        engine = chess.engine.SimpleEngine.popen_uci(self.command, timeout=self.timeout)
+        with self.lock:
+            self.engines.append(engine)
+        return engine
+
+    def restart(self, engine):
+        # a new engine in place of a broken one, None if it does not start
+        print('[ENGINE] restarting', self.command)
+        with self.lock:
+            if engine in self.engines:
+                self.engines.remove(engine)
+        try:
+            engine.close()
+        except Exception:
+            pass
+        try:
+            return self.start()
+        except Exception as e:
+            # the next checkout starts one again
+            with self.lock:
+                self.started -= 1
+            print('[ENGINE] could not restart', self.command, e)
+            return None
+
+    def checkout(self, timeout=None):
+        # wait up to timeout seconds for an idle engine
+        if self.closed:
+            raise EngineTimeout('engine pool is closed')
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            start = self.started < self.size
+            if start:
+                self.started += 1
+        if start:
+            try:
+                return self.start()
+            except Exception:
+                with self.lock:
+                    self.started -= 1
+                raise
+        try:
+            return self.idle.get(timeout=timeout)
+        except queue.Empty:
+            raise EngineTimeout('no engine available after %ss' % timeout)
+
+    def warm(self):
+        # start an engine of a lazy pool ahead of its first request
+        try:
+            engine = self.checkout(0)
+        except Exception as e:
+            print('[ENGINE] could not start', self.command, e)
+            return
+        self.checkin(engine)
+
+    def checkin(self, engine, broken=False):
+        if self.closed:
+            engine.close()
+            return
+        if broken:
+            engine = self.restart(engine)
+            if engine is None:
+                return
+        self.idle.put(engine)
+
+    @contextmanager
+    def engine(self, timeout=None):
+        engine = self.checkout(timeout)
+        broken = False
+        try:
+            yield engine
+        except (chess.engine.EngineTerminatedError, chess.engine.EngineError, asyncio.TimeoutError):
+            broken = True
+            raise
+        finally:
+            self.checkin(engine, broken)
+
+    def close(self):
+        self.closed = True
+        with self.lock:
+            engines = list(self.engines)
+            self.engines = []
+        for engine in engines:
+            try:
+                engine.quit()
+            except Exception:
+                engine.close()
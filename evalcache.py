@@ -0,0 +1,138 @@
+# evalcache.py
+
+import os
+import json
+import threading
+
+from collections import OrderedDict
+
+import chess
+import chess.engine
+import chess.polyglot
+
+CACHE_VERSION = 1
+
+# rough python memory per cached line and per pv move, used for the memory cap
+ENTRY_BYTES = 400
+MOVE_BYTES = 60
+
+def root_key(root_moves):
+    return ' '.join(sorted(m.uci() for m in root_moves)) if root_moves else ''
+
+def score_to_json(score):
+    # PovScore -> [turn, cp, mate]
+    relative = score.relative
+    return [score.turn, relative.score(), relative.mate()]
+
+def score_from_json(value):
+    turn, cp, mate = value
+    return chess.engine.PovScore(chess.engine.Mate(mate) if mate is not None else chess.engine.Cp(cp), turn)
+
+class Entry:
+    __slots__ = ('depth', 'time', 'nodes', 'lines')
+
+    def __init__(self, depth, time, nodes, lines):
+        self.depth = depth
+        self.time = time
+        self.nodes = nodes
+        # list of info dicts with score, pv and depth
+        self.lines = lines
+
+    def satisfies(self, limit):
+        # a search at least as deep/long as the one asked for
+        if limit.depth is not None and self.depth >= limit.depth:
+            return True
+        if limit.time is not None and self.time is not None and self.time >= limit.time:
+            return True
+        if limit.nodes is not None and self.nodes is not None and self.nodes >= limit.nodes:
+            return True
+        return False
+
+    def size(self):
+        return ENTRY_BYTES + sum(ENTRY_BYTES + MOVE_BYTES * len(line.get('pv', ())) for line in self.lines)
+
+# lru cache of engine results keyed by zobrist hash, root moves and multipv
+class EvalCache:
+    def __init__(self, max_bytes=64 << 20):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def key(self, board, multipv=None, root_moves=None):
+        return (chess.polyglot.zobrist_hash(board), root_key(root_moves), multipv or 1)
+
+    def get(self, board, limit, multipv=None, root_moves=None):
+        # cached lines for a search at least as deep as limit, or None
+        key = self.key(board, multipv, root_moves)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or not entry.satisfies(limit):
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry.lines
+
+    def put(self, board, limit, lines, multipv=None, root_moves=None):
+        lines = [self.trim(info) for info in lines]
+        depth = min((info.get('depth', 0) for info in lines), default=0)
+        if limit.depth is not None:
+            depth = max(depth, limit.depth)
+        self.add(self.key(board, multipv, root_moves), Entry(depth, limit.time, limit.nodes, lines))
+
+    def add(self, key, entry):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old.size()
+                if old.depth > entry.depth:
+                    # keep the deeper result
+                    entry = old
+            self.entries[key] = entry
+            self.bytes += entry.size()
+            while self.bytes > self.max_bytes and len(self.entries) > 1:
+                _, evicted = self.entries.popitem(last=False)
+                self.bytes -= evicted.size()
+
+    def trim(self, info):
+        line = {}
+        for name in ('score', 'pv', 'depth'):
+            if name in info:
+                line[name] = info[name]
+        return line
+
+    def load(self, file_name):
+        try:
+            with open(file_name) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if data.get('version') != CACHE_VERSION:
+            return False
+
+        for key, depth, time, nodes, lines in data['entries']:
+            self.add((key[0], key[1], key[2]), Entry(depth, time, nodes, [
+                {'score': score_from_json(score), 'pv': [chess.Move.from_uci(m) for m in pv.split()], 'depth': line_depth}
+                for score, pv, line_depth in lines]))
+        return True
+
+    def save(self, file_name):
+        with self.lock:
+            entries = [[list(key), entry.depth, entry.time, entry.nodes,
+                        [[score_to_json(line['score']), ' '.join(m.uci() for m in line.get('pv', ())), line.get('depth', 0)]
+                         for line in entry.lines if 'score' in line]]
+                       for key, entry in self.entries.items()]
+
+        temp_name = file_name + '.tmp'
+        try:
+            with open(temp_name, 'w') as f:
+                json.dump({'version': CACHE_VERSION, 'entries': entries}, f, separators=(',', ':'))
+            os.replace(temp_name, file_name)
+        except OSError as e:
+            print('[CACHE] could not write', file_name, e)
@@ -0,0 +1,105 @@
+# evalstore.py
+
+import os
+import struct
+import threading
+
+import chess.polyglot
+
+from openingdb import pack_move, unpack_move
+
+STORE_MAGIC = b'EVST'
+STORE_VERSION = 1
+STORE_SUFFIX = '.evals'
+
+HEADER = struct.Struct('<4sI')
+# position key, depth, number of moves
+RECORD = struct.Struct('<QBH')
+# packed move, score for the side to move
+MOVE_SCORE = struct.Struct('<Hi')
+
+# append-only file of pre-computed move scores keyed by zobrist hash
+class EvalStore:
+    def __init__(self):
+        self.positions = {}
+        self.lock = threading.Lock()
+        self.file = None
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __contains__(self, key):
+        return key in self.positions
+
+    def load(self, file_name):
+        # merge a store file into memory, returns the offset after its last complete record
+        # or 0 when file_name is not a store
+        try:
+            with open(file_name, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return 0
+        if len(data) < HEADER.size or HEADER.unpack_from(data, 0) != (STORE_MAGIC, STORE_VERSION):
+            return 0
+
+        offset = HEADER.size
+        positions = {}
+        while offset + RECORD.size <= len(data):
+            key, depth, move_count = RECORD.unpack_from(data, offset)
+            end = offset + RECORD.size + move_count * MOVE_SCORE.size
+            if end > len(data):
+                # partly written record from an interrupted run
+                break
+            scores = {}
+            for i in range(move_count):
+                move, score = MOVE_SCORE.unpack_from(data, offset + RECORD.size + i * MOVE_SCORE.size)
+                scores[move] = score
+            positions[key] = (depth, scores)
+            offset = end
+
+        with self.lock:
+            self.positions.update(positions)
+        return offset
+
+    def open(self, file_name):
+        # open for appending, keeping the complete records the file already holds
+        end = self.load(file_name)
+        if not end:
+            with open(file_name, 'wb') as f:
+                f.write(HEADER.pack(STORE_MAGIC, STORE_VERSION))
+        elif end < os.path.getsize(file_name):
+            # drop the partly written record of an interrupted run, the next one goes where it started
+            os.truncate(file_name, end)
+        self.file = open(file_name, 'ab')
+        return self
+
+    def add(self, key, depth, scores):
+        # scores: {chess.Move: score for the side to move}
+        packed = {pack_move(move): score for move, score in scores.items()}
+        with self.lock:
+            self.positions[key] = (depth, packed)
+            if self.file:
+                self.file.write(RECORD.pack(key, min(depth, 255), len(packed)))
+                for move, score in packed.items():
+                    self.file.write(MOVE_SCORE.pack(move, score))
+
+    def flush(self):
+        if self.file:
+            self.file.flush()
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def scores(self, board, moves=None):
+        # {move: score} for the position, None unless every one of moves is stored
+        entry = self.positions.get(chess.polyglot.zobrist_hash(board))
+        if entry is None:
+            return None
+        scores = {unpack_move(move): score for move, score in entry[1].items()}
+        if moves is not None:
+            if any(move not in scores for move in moves):
+                return None
+            return {move: scores[move] for move in moves}
+        return scores
@@ -0,0 +1,15 @@
+# evaluation.py
+
+# centipawn value reported for a forced mate
+MATE_SCORE = 100000
+
+def board_score(info):
+    # (score for the side to move, principal variation)
+    return info['score'].relative.score(mate_score=MATE_SCORE), info['pv']
+
+def moves_score(info):
+    # {root move: score for the side to move} from a multipv analysis
+    moves_score = {}
+    for i in range(len(info)):
+        moves_score[info[i]['pv'][0]] = info[i]['score'].relative.score(mate_score=MATE_SCORE)
+    return moves_score
@@ -0,0 +1,258 @@
+# explorer.py
+#
+# move statistics of a pgn for the opening explorer: for every position, each next move played
+# with its game count, results and average elo
+#   python explorer.py games.pgn
+# the tree (<pgn>.exp) is built in one pass over the pgn, extended when games are appended
+# and memory-mapped for lookups
+
+import os
+import sys
+import mmap
+import time
+import struct
+
+import chess
+import chess.pgn
+import chess.polyglot
+
+from pgnindex import file_hash
+from openingdb import pack_move, unpack_move
+
+TREE_MAGIC = b'EXPL'
+TREE_VERSION = 1
+TREE_SUFFIX = '.exp'
+
+# magic, version, pgn size, pgn mtime, pgn hash, game count, record count
+HEADER = struct.Struct('<4sIQd32sII')
+# position key, packed move, games, wins, draws, losses, elo sum, games with an elo
+# results and elo are those of the side making the move
+RECORD = struct.Struct('<QHIIIIQI')
+
+# result header to (wins, draws, losses) of white
+RESULTS = {'1-0': (1, 0, 0), '1/2-1/2': (0, 1, 0), '0-1': (0, 0, 1)}
+
+def parse_elo(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
+# collects the (key, move, turn) of every mainline move once per game, variations are skipped
+class TreeVisitor(chess.pgn.BaseVisitor):
+    def begin_game(self):
+        self.headers = {}
+        self.moves = set()
+
+    def visit_header(self, tagname, tagvalue):
+        self.headers[tagname] = tagvalue
+
+    def begin_variation(self):
+        return chess.pgn.SKIP
+
+    def visit_move(self, board, move):
+        # board is still before move
+        self.moves.add((chess.polyglot.zobrist_hash(board), pack_move(move), board.turn))
+
+    def result(self):
+        return self.headers, self.moves
+
+def read_moves(pgn_name, start=0):
+    # {(key, move): [games, wins, draws, losses, elo sum, elo count]} of the games from start on
+    stats = {}
+    games = 0
+    with open(pgn_name) as pgn_file:
+        pgn_file.seek(start)
+        while True:
+            game = chess.pgn.read_game(pgn_file, Visitor=TreeVisitor)
+            if game is None:
+                break
+            headers, moves = game
+            games += 1
+            white = RESULTS.get(headers.get('Result'), (0, 0, 0))
+            black = white[::-1]
+            white_elo = parse_elo(headers.get('WhiteElo'))
+            black_elo = parse_elo(headers.get('BlackElo'))
+            for key, move, turn in moves:
+                wins, draws, losses = white if turn == chess.WHITE else black
+                elo = white_elo if turn == chess.WHITE else black_elo
+                record = stats.get((key, move))
+                if record is None:
+                    record = stats[key, move] = [0, 0, 0, 0, 0, 0]
+                record[0] += 1
+                record[1] += wins
+                record[2] += draws
+                record[3] += losses
+                if elo:
+                    record[4] += elo
+                    record[5] += 1
+    return stats, games
+
+def merge(records, stats):
+    # records (sorted (key, move, ...) tuples) with stats added, still sorted
+    added = sorted(stats.items())
+    i = 0
+    for record in records:
+        while i < len(added) and added[i][0] < record[:2]:
+            yield added[i][0] + tuple(added[i][1])
+            i += 1
+        if i < len(added) and added[i][0] == record[:2]:
+            yield record[:2] + tuple(a + b for a, b in zip(record[2:], added[i][1]))
+            i += 1
+        else:
+            yield record
+    for key_move, values in added[i:]:
+        yield key_move + tuple(values)
+
+def build(pgn_name, tree_name, old=None):
+    # write the tree of the whole pgn, or extend old (a loaded MoveTree covering its start)
+    start = old.size if old else 0
+    stats, games = read_moves(pgn_name, start)
+    records = merge(old.records() if old else (), stats)
+
+    stat = os.stat(pgn_name)
+    count = 0
+    temp_name = tree_name + '.tmp'
+    with open(temp_name, 'wb') as f:
+        f.write(bytes(HEADER.size))
+        for record in records:
+            f.write(RECORD.pack(*record))
+            count += 1
+        games += old.games if old else 0
+        f.seek(0)
+        f.write(HEADER.pack(TREE_MAGIC, TREE_VERSION, stat.st_size, stat.st_mtime,
+                            file_hash(pgn_name, stat.st_size).encode('ascii'), games, count))
+    if old:
+        old.close()
+    os.replace(temp_name, tree_name)
+    return games, count
+
+class MoveTree:
+    def __init__(self, pgn_name):
+        self.pgn_name = pgn_name
+        self.tree_name = pgn_name + TREE_SUFFIX
+        self.file = None
+        self.map = None
+        self.size = 0
+        self.hash = None
+        self.games = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def read_header(self, data):
+        if len(data) < HEADER.size:
+            return None
+        header = HEADER.unpack_from(data, 0)
+        if header[0] != TREE_MAGIC or header[1] != TREE_VERSION:
+            return None
+        return header
+
+    def is_current(self):
+        # tree exists and was built from the pgn as it is now
+        try:
+            stat = os.stat(self.pgn_name)
+            with open(self.tree_name, 'rb') as f:
+                header = self.read_header(f.read(HEADER.size))
+        except OSError:
+            return False
+        return header is not None and header[2] == stat.st_size and header[3] == stat.st_mtime
+
+    def load(self):
+        # memory-map the tree, building it first when missing or out of date
+        # a pgn that only had games appended has just the new games read
+        self.close()
+        if not self.is_current():
+            old = self.open() if os.path.exists(self.tree_name) else None
+            stat = os.stat(self.pgn_name)
+            if old and not (old.size < stat.st_size and old.hash == file_hash(self.pgn_name, old.size)):
+                old.close()
+                old = None
+            build(self.pgn_name, self.tree_name, old)
+        return self.open()
+
+    def open(self):
+        self.close()
+        try:
+            self.file = open(self.tree_name, 'rb')
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            self.close()
+            return None
+        header = self.read_header(self.map)
+        if header is None:
+            self.close()
+            return None
+        _, _, self.size, _, pgn_hash, self.games, self.count = header
+        self.hash = pgn_hash.decode('ascii')
+        return self
+
+    def close(self):
+        if self.map:
+            self.map.close()
+            self.map = None
+        if self.file:
+            self.file.close()
+            self.file = None
+        self.size = self.games = self.count = 0
+
+    def record(self, i):
+        return RECORD.unpack_from(self.map, HEADER.size + i * RECORD.size)
+
+    def records(self):
+        for i in range(self.count):
+            yield self.record(i)
+
+    def key(self, i):
+        return struct.unpack_from('<Q', self.map, HEADER.size + i * RECORD.size)[0]
+
+    def find(self, key):
+        # [(move, games, wins, draws, losses, average elo)] of the moves played from the position
+        if not self.map:
+            return []
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        moves = []
+        while lo < self.count:
+            record_key, move, games, wins, draws, losses, elo_sum, elo_count = self.record(lo)
+            if record_key != key:
+                break
+            moves.append((unpack_move(move), games, wins, draws, losses, elo_sum // elo_count if elo_count else 0))
+            lo += 1
+        return moves
+
+    def find_board(self, board):
+        return self.find(chess.polyglot.zobrist_hash(board))
+
+def explore(tree, book, board):
+    # [(move, games, score %, average elo, book weight %)] of the next moves seen in the games or
+    # the book, most played first, book moves the games never reached after them
+    moves = {}
+    if tree is not None:
+        for move, games, wins, draws, losses, elo in tree.find_board(board):
+            moves[move] = [move, games, (wins + draws / 2) * 100 / games, elo, 0]
+    if book is not None:
+        entries = list(book.find_all(board))
+        total = sum(entry.weight for entry in entries)
+        for entry in entries:
+            row = moves.setdefault(entry.move, [entry.move, 0, None, None, 0])
+            row[4] += entry.weight * 100 / total if total else 0
+    return sorted((tuple(row) for row in moves.values()), key=lambda row: (-row[1], -row[4]))
+
+def main(argv):
+    if not argv:
+        print('usage: python explorer.py <pgn>')
+        return
+    started = time.time()
+    tree = MoveTree(argv[0]).load()
+    print('%s: %d games, %d moves in %.2fs' % (tree.tree_name, tree.games, len(tree), time.time() - started))
+    tree.close()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
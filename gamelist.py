@@ -0,0 +1,66 @@
+# gamelist.py
+
+from PyQt5.QtCore import Qt, QAbstractListModel, QModelIndex
+
+# rows handed to the view per fetchMore
+FETCH_BATCH = 256
+
+def game_list_text(pgn_index, i):
+    return str(i+1) + '. [' + pgn_index.get('Result', i) + '] ' + \
+        pgn_index.get('White', i) + ' ' + pgn_index.get('WhiteElo', i) + ' vs ' + \
+        pgn_index.get('Black', i) + ' ' + pgn_index.get('BlackElo', i)
+
+def tactics_list_text(pgn_index, i):
+    return str(i+1) + '. [' + pgn_index.get('Result', i) + '] ' + \
+        pgn_index.get('White', i) + ' vs ' + pgn_index.get('Black', i)
+
+# list model over a PgnIndex, rows are formatted only when the view asks for them
+# rows limits the list to those game numbers, e.g. the results of a search
+class GameListModel(QAbstractListModel):
+    def __init__(self, pgn_index, formatter, parent=None, rows=None):
+        super().__init__(parent)
+
+        self.pgn_index = pgn_index
+        self.formatter = formatter
+        self.rows = rows
+        self.loaded = 0
+
+    def __len__(self):
+        return len(self.pgn_index) if self.rows is None else len(self.rows)
+
+    def game(self, row):
+        # game number in the pgn of a list row
+        return row if self.rows is None else self.rows[row]
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return self.loaded
+
+    def canFetchMore(self, parent):
+        if parent.isValid():
+            return False
+        return self.loaded < len(self)
+
+    def fetchMore(self, parent):
+        if parent.isValid():
+            return
+        count = min(FETCH_BATCH, len(self) - self.loaded)
+        if count <= 0:
+            return
+        self.beginInsertRows(QModelIndex(), self.loaded, self.loaded + count - 1)
+        self.loaded += count
+        self.endInsertRows()
+
+    def data(self, model_index, role=Qt.DisplayRole):
+        if not model_index.isValid():
+            return None
+        if role == Qt.DisplayRole:
+            return self.formatter(self.pgn_index, self.game(model_index.row()))
+        return None
+
+    def offset(self, row):
+        return self.pgn_index.offsets[self.game(row)]
+
+    def header(self, row):
+        return self.pgn_index.header(self.game(row))
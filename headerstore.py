@@ -0,0 +1,280 @@
+# headerstore.py
+#
+# columnar copy of the indexed pgn headers for filtering and sorting a game list
+#   player:carlsen white:so black:nakamura elo:2500-2800 eco:B20-B99 result:1-0 date:2010-2015 sort:-date
+# bare words match either player, filters are and-ed
+
+
+import sys
+
+from array import array
+from itertools import compress, accumulate
+
+from pgnindex import intern
+
+RESULTS = ['1-0', '0-1', '1/2-1/2', '*']
+
+# rough relative cost of setting one row by hand and of translating one byte of a plane
+SCATTER_COST = 200
+TRANSLATE_COST = 3
+
+# rows of a sort order looked at per step when a sorted list is read
+SCAN_CHUNK = 4096
+
+# sort names accepted by sort:, mapped to columns
+SORT_COLUMNS = {
+    'white': 'White', 'black': 'Black', 'event': 'Event', 'date': 'Date', 'eco': 'ECO', 'result': 'Result',
+    'elo': 'Elo', 'whiteelo': 'WhiteElo', 'blackelo': 'BlackElo',
+}
+
+class QueryError(ValueError):
+    pass
+
+def parse_elo(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
+def parse_date(value):
+    # yyyymmdd with unknown parts as 0, '2015.??.??' -> 20150000
+    parts = (value or '').split('.')
+    number = 0
+    for part, scale in zip(parts + ['', '', ''], (10000, 100, 1)):
+        if part.isdigit():
+            number += int(part) * scale
+    return number
+
+def parse_eco(value):
+    # 'B20' -> 120, unknown sorts last
+    if value and len(value) == 3 and value[0] in 'ABCDE' and value[1:].isdigit():
+        return 'ABCDE'.index(value[0]) * 100 + int(value[1:])
+    return 500
+
+# a column stored as ids into its sorted distinct values, so ids compare like the values
+# masks are ints with one byte (0 or 1) per row, row 0 in the lowest byte
+class Column:
+    def __init__(self, values, typecode='I'):
+        self.values = sorted(set(values))
+        value_ids = {value: i for i, value in enumerate(self.values)}
+        self.ids = array(typecode, map(value_ids.__getitem__, values))
+
+        # rows sorted by value, stable so equal values stay in file order
+        self.order = array('I', sorted(range(len(self.ids)), key=self.ids.__getitem__))
+        # rows of value id i are order[starts[i]:starts[i+1]]
+        counts = [0] * (len(self.values) + 1)
+        for i in self.ids:
+            counts[i + 1] += 1
+        self.starts = array('I', accumulate(counts))
+
+        # byte planes of the ids, most significant first, for bytes.translate
+        width = max(1, (len(self.values) - 1).bit_length() + 7 >> 3)
+        ids = array('I', self.ids)
+        if sys.byteorder == 'big':
+            ids.byteswap()
+        raw = ids.tobytes()
+        self.planes = [raw[b::4] for b in reversed(range(width))]
+        self.all = int.from_bytes(b'\1' * len(self.ids), 'little')
+
+    def mask(self, test):
+        return self.select([i for i, value in enumerate(self.values) if test(value)])
+
+    def select(self, ids):
+        # mask of the rows whose value id is in ids (ascending)
+        if not ids:
+            return 0
+        if len(ids) == len(self.values):
+            return self.all
+        if len(ids) > len(self.values) // 2:
+            # fewer ids to look for the other way round
+            chosen = set(ids)
+            return self.all ^ self.select([i for i in range(len(self.values)) if i not in chosen])
+
+        groups = self.groups(ids, 0)
+        rows = sum(self.starts[i + 1] - self.starts[i] for i in ids)
+        if rows * SCATTER_COST < len(groups) * len(self.planes) * len(self.ids) * TRANSLATE_COST:
+            return self.scatter(ids)
+        return self.translate(ids, 0, 0)
+
+    def groups(self, ids, level):
+        # ids grouped by their byte at level
+        shift = 8 * (len(self.planes) - 1 - level)
+        groups = {}
+        for i in ids:
+            groups.setdefault(i >> shift & 255, []).append(i)
+        return groups
+
+    def translate(self, ids, level, prefix):
+        # ids all share the bytes above level, given by prefix
+        plane = self.planes[level]
+        if level == len(self.planes) - 1:
+            return plane_mask(plane, [i & 255 for i in ids])
+
+        shift = 8 * (len(self.planes) - 1 - level)
+        full = []
+        mask = 0
+        for byte, group in self.groups(ids, level).items():
+            # a byte whose every existing id is wanted needs no lower planes
+            base = prefix | byte << shift
+            if len(group) == min(1 << shift, len(self.values) - base):
+                full.append(byte)
+            else:
+                mask |= plane_mask(plane, [byte]) & self.translate(group, level + 1, base)
+        if full:
+            mask |= plane_mask(plane, full)
+        return mask
+
+    def scatter(self, ids):
+        # set the rows one by one, cheaper when few rows match
+        mask = bytearray(len(self.ids))
+        for i in ids:
+            for row in self.order[self.starts[i]:self.starts[i + 1]]:
+                mask[row] = 1
+        return int.from_bytes(mask, 'little')
+
+def plane_mask(plane, byte_values):
+    table = bytearray(256)
+    for byte in byte_values:
+        table[byte] = 1
+    return int.from_bytes(plane.translate(table), 'little')
+
+def value_range(text, parse):
+    # 'lo-hi', 'lo-', '-hi' or a single value
+    low, dash, high = text.partition('-')
+    if not dash:
+        high = low
+    try:
+        return (parse(low) if low else None), (parse(high) if high else None)
+    except ValueError:
+        raise QueryError('bad range ' + text)
+
+def in_range(low, high):
+    return lambda value: (low is None or value >= low) and (high is None or value <= high)
+
+class HeaderStore:
+    def __init__(self, pgn_index):
+        columns = pgn_index.columns
+        self.count = len(pgn_index)
+        self.columns = {
+            'White': Column([intern(v or '') for v in columns['White']]),
+            'Black': Column([intern(v or '') for v in columns['Black']]),
+            'Event': Column([intern(v or '') for v in columns['Event']]),
+            'WhiteElo': Column([parse_elo(v) for v in columns['WhiteElo']], 'H'),
+            'BlackElo': Column([parse_elo(v) for v in columns['BlackElo']], 'H'),
+            'Date': Column([parse_date(v) for v in columns['Date']]),
+            'ECO': Column([parse_eco(v) for v in columns['ECO']], 'H'),
+            'Result': Column([RESULTS.index(v) if v in RESULTS else 3 for v in columns['Result']], 'B'),
+        }
+        white, black = self.columns['WhiteElo'], self.columns['BlackElo']
+        self.columns['Elo'] = Column([(white.values[w] + black.values[b]) // 2
+                                      for w, b in zip(white.ids, black.ids)], 'H')
+        # lower case player names, made on the first player search
+        self.folded = {}
+
+    def __len__(self):
+        return self.count
+
+    def player_mask(self, text, columns=('White', 'Black')):
+        text = text.lower()
+        mask = None
+        for name in columns:
+            if name not in self.folded:
+                self.folded[name] = [value.lower() for value in self.columns[name].values]
+            column_mask = self.columns[name].select([i for i, value in enumerate(self.folded[name]) if text in value])
+            mask = column_mask if mask is None else mask | column_mask
+        return mask
+
+    def filter_mask(self, name, value):
+        if name == 'player':
+            return self.player_mask(value)
+        if name in ('white', 'black'):
+            return self.player_mask(value, (name.capitalize(),))
+        if name == 'elo':
+            # both players inside the range
+            test = in_range(*value_range(value, int))
+            return self.columns['WhiteElo'].mask(test) & self.columns['BlackElo'].mask(test)
+        if name == 'eco':
+            low, high = value.upper().split('-', 1) if '-' in value else (value.upper(), value.upper())
+            # a prefix such as 'B' or 'B2' covers every code it starts
+            low, high = (low + '00')[:3], (high + '99')[:3]
+            if parse_eco(low) == 500 or parse_eco(high) == 500:
+                raise QueryError('bad eco ' + value)
+            return self.columns['ECO'].mask(in_range(parse_eco(low), parse_eco(high)))
+        if name == 'result':
+            result = {'draw': '1/2-1/2', '1/2': '1/2-1/2', '=': '1/2-1/2'}.get(value, value)
+            if result not in RESULTS:
+                raise QueryError('bad result ' + value)
+            return self.columns['Result'].mask(lambda code: code == RESULTS.index(result))
+        if name == 'date':
+            low, high = value_range(value, lambda v: v)
+            low = parse_date(low) if low else None
+            # an upper bound of a year or month includes all of it
+            high = parse_date(high) + (9999 if len(high) == 4 else 99 if len(high) == 7 else 0) if high else None
+            return self.columns['Date'].mask(in_range(low, high))
+        raise QueryError('unknown filter ' + name)
+
+    def query(self, text):
+        # game numbers matching text in the requested order, None for every game in file order
+        mask = None
+        sort = None
+        for word in text.split():
+            name, colon, value = word.partition(':')
+            if not colon:
+                name, value = 'player', word
+            name = name.lower()
+            if name == 'sort':
+                descending = value.startswith('-')
+                column = SORT_COLUMNS.get(value.lstrip('-').lower())
+                if column is None:
+                    raise QueryError('cannot sort by ' + value)
+                sort = (column, descending)
+            elif value:
+                mask = self.filter_mask(name, value) if mask is None else mask & self.filter_mask(name, value)
+
+        if mask is not None:
+            mask = mask.to_bytes(self.count, 'little')
+        if sort is None:
+            if mask is None:
+                return None
+            return list(compress(range(self.count), mask))
+
+        column = self.columns[sort[0]]
+        if mask is not None and mask.count(1) <= self.count // 8:
+            # stable sort of the few matching rows by value, as column.order would list them
+            rows = sorted(compress(range(self.count), mask), key=column.ids.__getitem__)
+            if sort[1]:
+                rows.reverse()
+            return rows
+        return SortedRows(column.order, mask, sort[1])
+
+# the rows of a mask in the order of a sorted column, picked out as the list is read
+# so a sort over most of a large database costs only the rows shown
+class SortedRows:
+    def __init__(self, order, mask, descending):
+        self.order = order
+        self.mask = mask
+        self.descending = descending
+        self.count = len(order) if mask is None else mask.count(1)
+        self.rows = []
+        self.scanned = 0
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.count
+        while len(self.rows) <= i and self.scanned < len(self.order):
+            start = self.scanned
+            end = min(start + SCAN_CHUNK, len(self.order))
+            if self.descending:
+                chunk = self.order[len(self.order) - end:len(self.order) - start][::-1]
+            else:
+                chunk = self.order[start:end]
+            self.rows.extend(chunk if self.mask is None else compress(chunk, map(self.mask.__getitem__, chunk)))
+            self.scanned = end
+        return self.rows[i]
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self[i]
@@ -0,0 +1,153 @@
+# instrument.py
+#
+# opt-in timers, counters and latency histograms for the hot paths
+#   import instrument
+#   instrument.enable()
+#   with instrument.timer('book.probe'):
+#       ...
+#   instrument.dump('instrument.json')
+# nothing is recorded until enable() is called, a disabled timer or counter is a flag check
+
+import json
+import math
+import time
+import functools
+import threading
+
+from contextlib import contextmanager, nullcontext
+
+# histogram buckets grow by this factor, so a percentile is read to within ~5%
+BUCKET_GROWTH = 1.1
+# smallest value told apart, in ms, and the number of buckets above it (up to ~ 1.1^256 us, hours)
+BUCKET_MIN = 0.001
+BUCKET_COUNT = 256
+
+LOG_GROWTH = math.log(BUCKET_GROWTH)
+
+enabled = False
+histograms = {}
+counters = {}
+lock = threading.Lock()
+
+# ms values counted in geometric buckets, recording is a log and an increment
+class Histogram:
+    def __init__(self):
+        self.buckets = [0] * BUCKET_COUNT
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, ms):
+        index = int(math.log(ms / BUCKET_MIN) / LOG_GROWTH) + 1 if ms > BUCKET_MIN else 0
+        self.buckets[min(index, BUCKET_COUNT - 1)] += 1
+        self.count += 1
+        self.total += ms
+        if ms > self.max:
+            self.max = ms
+
+    def percentile(self, p):
+        # middle of the bucket holding the p-th value, p from 0 to 1
+        if not self.count:
+            return 0.0
+        rank = p * self.count
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank and count:
+                return min(BUCKET_MIN * BUCKET_GROWTH ** max(0, index - 0.5), self.max)
+        return self.max
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def summary(self):
+        return {'count': self.count, 'mean_ms': round(self.mean(), 4), 'p50_ms': round(self.percentile(0.5), 4),
+                'p95_ms': round(self.percentile(0.95), 4), 'p99_ms': round(self.percentile(0.99), 4),
+                'max_ms': round(self.max, 4)}
+
+def enable():
+    global enabled
+    enabled = True
+
+def reset():
+    with lock:
+        histograms.clear()
+        counters.clear()
+
+def record(name, ms):
+    if not enabled:
+        return
+    with lock:
+        histogram = histograms.get(name)
+        if histogram is None:
+            histogram = histograms[name] = Histogram()
+        histogram.record(ms)
+
+def count(name, n=1):
+    if not enabled:
+        return
+    with lock:
+        counters[name] = counters.get(name, 0) + n
+
+@contextmanager
+def measure(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, (time.perf_counter() - started) * 1000)
+
+# the timer of a disabled instrument, reused
+NOTHING = nullcontext()
+
+def timer(name):
+    # context manager timing its block into the histogram name
+    return measure(name) if enabled else NOTHING
+
+def timed(name):
+    # decorator timing every call of a function
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return fn(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                record(name, (time.perf_counter() - started) * 1000)
+        return wrapper
+    return decorate
+
+def time_future(name, future):
+    # records the time until future is done, returns future
+    if enabled:
+        started = time.perf_counter()
+        future.add_done_callback(lambda f: record(name, (time.perf_counter() - started) * 1000))
+    return future
+
+def status(names):
+    # 'name p50/p95 ms' of the histograms that have values, for a status bar
+    parts = []
+    with lock:
+        for name in names:
+            histogram = histograms.get(name)
+            if histogram and histogram.count:
+                parts.append('%s %.2f/%.2f' % (name, histogram.percentile(0.5), histogram.percentile(0.95)))
+    return '  '.join(parts) + (' ms (p50/p95)' if parts else '')
+
+def snapshot():
+    with lock:
+        return {
+            'histograms': {name: histogram.summary() for name, histogram in sorted(histograms.items())},
+            'counters': dict(sorted(counters.items())),
+        }
+
+def dump(file_name):
+    data = snapshot()
+    data['time'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+    try:
+        with open(file_name, 'w') as f:
+            json.dump(data, f, indent=1)
+    except OSError as e:
+        print('[INSTRUMENT] could not write', file_name, e)
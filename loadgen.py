@@ -0,0 +1,149 @@
+# loadgen.py
+#
+# simulates many clients playing each other through a server on localhost
+#   python loadgen.py [--clients 200] [--moves 40] [--port 5556] [--timeout 120]
+# starts its own quiet server unless --external is given, reports move relay latency and throughput
+
+import sys
+import time
+import random
+import asyncio
+import argparse
+import threading
+
+import chess
+
+from server import Server
+from protocol import PROTOCOL_VERSION, FrameDecoder, encode
+
+# seconds a whole simulation may take before it is abandoned
+SIM_TIMEOUT = 120
+
+class SimClient:
+    def __init__(self, name, stats):
+        self.name = name
+        self.stats = stats
+        self.games = {}
+        self.sent = {}
+        self.opponent = None
+        self.writer = None
+        self.done = asyncio.Event()
+
+    async def run(self, host, port, opponent, max_moves):
+        self.max_moves = max_moves
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        self.writer.write(encode('HELLO', PROTOCOL_VERSION) + encode('NEW', self.name))
+        # challenged as soon as the opponent shows up in the presence list
+        self.opponent = opponent
+        decoder = FrameDecoder()
+        while not self.done.is_set():
+            data = await self.reader.read(65536)
+            if not data:
+                break
+            for cmd, args in decoder.feed(data):
+                self.handle(cmd, args)
+        self.writer.close()
+
+    def handle(self, cmd, args):
+        if cmd in ('SNAPSHOT', 'JOIN') and self.opponent in args[1:]:
+            self.writer.write(encode('CHALLENGE', self.opponent))
+            self.opponent = None
+        elif cmd == 'CHALLENGE':
+            self.writer.write(encode('ACCEPT', args[0]))
+        elif cmd == 'START' and self.name in args[1:3]:
+            board = chess.Board()
+            color = chess.WHITE if args[1] == self.name else chess.BLACK
+            self.games[args[0]] = (board, color)
+            self.play(args[0])
+        elif cmd == 'MOVE' and args[0] in self.games:
+            board, color = self.games[args[0]]
+            sent = self.sent.pop(args[0], None)
+            if sent:
+                self.stats.latencies.append(time.perf_counter() - sent)
+            board.push_uci(args[1])
+            self.stats.moves += 1
+            self.play(args[0])
+        elif cmd == 'END' and args[0] in self.games:
+            del self.games[args[0]]
+            if not self.games:
+                self.done.set()
+
+    def play(self, game_id):
+        board, color = self.games[game_id]
+        if board.turn != color:
+            return
+        moves = list(board.legal_moves)
+        if not moves or len(board.move_stack) >= self.max_moves:
+            # leaving ends the game for both sides
+            self.done.set()
+            return
+        self.sent[game_id] = time.perf_counter()
+        self.writer.write(encode('MOVE', game_id, random.choice(moves).uci()))
+
+class Stats:
+    def __init__(self):
+        self.latencies = []
+        self.moves = 0
+        self.timed_out = False
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+async def simulate(host, port, clients, moves, timeout=SIM_TIMEOUT):
+    # clients play in pairs, a client without an opponent would wait forever
+    if clients % 2:
+        raise ValueError('an even number of clients is needed, got %d' % clients)
+    stats = Stats()
+    sims = [SimClient('sim%d' % i, stats) for i in range(clients)]
+    started = time.perf_counter()
+    runs = asyncio.gather(*[sim.run(host, port, sims[i + 1].name if i % 2 == 0 else None, moves)
+                            for i, sim in enumerate(sims)], return_exceptions=True)
+    try:
+        await asyncio.wait_for(runs, timeout)
+    except asyncio.TimeoutError:
+        stats.timed_out = True
+        for sim in sims:
+            if sim.writer:
+                sim.writer.close()
+    return stats, time.perf_counter() - started
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Load test the chess server with simulated clients')
+    parser.add_argument('--clients', type=int, default=200, help='even, the clients play in pairs')
+    parser.add_argument('--moves', type=int, default=40, help='plies per game')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=5556)
+    parser.add_argument('--external', action='store_true', help='use a server that is already running')
+    parser.add_argument('--timeout', type=float, default=SIM_TIMEOUT, help='seconds before the run is abandoned')
+    args = parser.parse_args(argv)
+    if args.clients < 2 or args.clients % 2:
+        parser.error('--clients must be an even number of at least 2')
+
+    server = None
+    if not args.external:
+        server = Server(args.host, args.port, verbose=False)
+        ok, msg = server.connect()
+        if not ok:
+            print(msg)
+            return
+        threading.Thread(target=server.listen, daemon=True).start()
+        time.sleep(0.2)
+
+    stats, elapsed = asyncio.run(simulate(args.host, args.port, args.clients, args.moves, args.timeout))
+    if server:
+        server.stop()
+
+    if stats.timed_out:
+        print('timed out after %gs, the results below are partial' % args.timeout)
+
+    print('%d clients, %d games, %d moves relayed in %.2fs (%.0f moves/s)' %
+          (args.clients, args.clients // 2, stats.moves, elapsed, stats.moves / max(elapsed, 1e-9)))
+    print('relay latency p50 %.2fms, p95 %.2fms, max %.2fms' %
+          (percentile(stats.latencies, 0.5) * 1000, percentile(stats.latencies, 0.95) * 1000,
+           max(stats.latencies, default=0) * 1000))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -6,26 +6,36 @@ Requires python-chess
 import traceback
 import sys
 import os
+import time
+import bisect
 import random
 
+# start of the process as far as startup profiling is concerned
+STARTED = time.perf_counter()
+
 from threading import Thread
+from concurrent.futures import Future
 from _thread import *
 from qboard import QBoard
 
-from client import Client
-from server import Server
+from coach import Coach
+from pgnindex import PgnIndex
+from gamelist import GameListModel, game_list_text, tactics_list_text
+from positionindex import PositionIndex
+from headerstore import HeaderStore, QueryError
+from explorer import MoveTree, explore
+from review import GameReview
+from evalstore import STORE_SUFFIX
+import instrument
 
 import chess
-import chess.engine
 import chess.pgn
-import chess.polyglot
-import chess.svg
 
 #import chess.uci
-from PyQt5.QtCore import Qt, QTime, QTimer, QRectF, QSize
+from PyQt5.QtCore import Qt, QTime, QTimer, QRectF, QSize, QEvent, pyqtSignal
 from PyQt5.QtGui import QPixmap, QPainter, QImage, QIcon
 from PyQt5.QtWidgets import QApplication, QWidget, QAction, QMainWindow, QVBoxLayout, QHBoxLayout
-from PyQt5.QtWidgets import QTabWidget, QFileDialog, QListWidget, QListWidgetItem, QLabel, QInputDialog, QLineEdit
+from PyQt5.QtWidgets import QTabWidget, QFileDialog, QListWidget, QListWidgetItem, QListView, QLabel, QInputDialog, QLineEdit, QMessageBox
 
 class TabEmpty(QWidget):
     def __init__(self, parent, caption):
@@ -49,37 +59,230 @@ class TabGame(TabEmpty):
         super().__init__(parent, caption)
         
         self.can_move = True
+        # san of every move played, appended as moves are made
+        self.san_moves = []
+        self.moves_text = ''
         
         self.boardWidget = QBoard(self)
         self.layout.addWidget(self.boardWidget, 1)
     
     def get_last_move(self):
         return None
+
+    def append_san(self, move):
+        # same text as variation_san, built one move at a time
+        san = self.board.san(move)
+        if self.board.turn == chess.WHITE:
+            token = str(self.board.fullmove_number) + '. ' + san
+        elif not self.san_moves:
+            token = str(self.board.fullmove_number) + '...' + san
+        else:
+            token = san
+        self.san_moves.append(san)
+        self.moves_text += (' ' if self.moves_text else '') + token
         
 class TabServer(TabEmpty):
+    # messages arrive on the client thread, the signals handle them on the ui thread
+    userAdded = pyqtSignal(str)
+    userRemoved = pyqtSignal(str)
+    usersSet = pyqtSignal(list)
+    challengeReceived = pyqtSignal(str)
+    challengeDeclined = pyqtSignal(str)
+    gameStarted = pyqtSignal(str, str, str)
+    gameSnapshot = pyqtSignal(str, str, str, list)
+    gameMoved = pyqtSignal(str, str)
+    gameEnded = pyqtSignal(str, str)
+    # the server accepted the username and sent the users, or refused the join with a reason
+    joined = pyqtSignal()
+    rejected = pyqtSignal(str)
+
     def __init__(self, parent, caption):
         super().__init__(parent, caption)
         
+        self.layout.addWidget(QLabel('Users (double click to challenge)'))
         self.list = QListWidget()
+        self.list.itemDoubleClicked.connect(self.on_user_dbl_click)
         self.layout.addWidget(self.list)
+        self.user_items = {}
+
+        self.layout.addWidget(QLabel('Games (double click to watch)'))
+        self.games_list = QListWidget()
+        self.games_list.itemDoubleClicked.connect(self.on_game_dbl_click)
+        self.layout.addWidget(self.games_list)
+        self.game_items = {}
+        self.game_tabs = {}
         
         self.client = None
         self.server = None
+
+        self.userAdded.connect(self.add_user_item)
+        self.userRemoved.connect(self.remove_user_item)
+        self.usersSet.connect(self.set_user_items)
+        self.challengeReceived.connect(self.on_challenge)
+        self.challengeDeclined.connect(self.on_declined)
+        self.gameStarted.connect(self.on_game_started)
+        self.gameSnapshot.connect(self.on_game_snapshot)
+        self.gameMoved.connect(self.on_game_moved)
+        self.gameEnded.connect(self.on_game_ended)
         
     def addUser(self, username):
-        self.list.addItem(QListWidgetItem(username))
+        self.userAdded.emit(username)
+
+    def removeUser(self, username):
+        self.userRemoved.emit(username)
+
+    def setUsers(self, usernames):
+        self.usersSet.emit(list(usernames))
     
     def clearUsers(self):
+        self.usersSet.emit([])
+
+    def add_user_item(self, username):
+        if username not in self.user_items:
+            item = QListWidgetItem(username)
+            self.user_items[username] = item
+            self.list.addItem(item)
+
+    def remove_user_item(self, username):
+        item = self.user_items.pop(username, None)
+        if item:
+            self.list.takeItem(self.list.row(item))
+
+    def set_user_items(self, usernames):
         self.list.clear()
+        self.user_items = {}
+        for username in usernames:
+            self.add_user_item(username)
+
+    def on_user_dbl_click(self, item):
+        if self.client and item.text() != self.client.username:
+            self.client.challenge(item.text())
+            self.parent.add_message('Challenged '+item.text())
+
+    def on_game_dbl_click(self, item):
+        game_id = item.data(Qt.UserRole)
+        if self.client and game_id not in self.game_tabs:
+            self.client.watch(game_id)
+
+    def on_challenge(self, username):
+        answer = QMessageBox.question(self, 'Challenge', username+' challenges you to a game. Accept?')
+        if answer == QMessageBox.Yes:
+            self.client.accept(username)
+        else:
+            self.client.decline(username)
+
+    def on_declined(self, username):
+        self.parent.add_message(username+' declined your challenge')
+
+    def on_game_started(self, game_id, white, black):
+        item = QListWidgetItem(game_id+'. '+white+' vs '+black)
+        item.setData(Qt.UserRole, game_id)
+        self.game_items[game_id] = item
+        self.games_list.addItem(item)
+
+        username = self.client.username if self.client else None
+        if username == white or username == black:
+            self.open_game(game_id, white, black, chess.WHITE if username == white else chess.BLACK)
+
+    def on_game_snapshot(self, game_id, white, black, moves):
+        if game_id not in self.game_tabs:
+            self.open_game(game_id, white, black, None, moves)
+
+    def open_game(self, game_id, white, black, color, moves=()):
+        tab = TabNetGame(self.parent, self, game_id, white, black, color, moves)
+        self.game_tabs[game_id] = tab
+        self.parent.tabs.addTab(tab, 'Game '+game_id)
+        self.parent.tabs.setCurrentIndex(self.parent.tabs.count()-1)
+
+    def on_game_moved(self, game_id, uci):
+        tab = self.game_tabs.get(game_id)
+        if tab:
+            tab.remote_move(uci)
+
+    def on_game_ended(self, game_id, result):
+        item = self.game_items.pop(game_id, None)
+        if item:
+            self.games_list.takeItem(self.games_list.row(item))
+        tab = self.game_tabs.pop(game_id, None)
+        if tab:
+            tab.game_over(result)
+
+    def game_closed(self, game_id):
+        self.game_tabs.pop(game_id, None)
         
     def closing(self):
         if self.client:
+            if self.client in self.parent.coach.remote_clients:
+                self.parent.coach.remote_clients.remove(self.client)
             self.client.stop()
             self.client = None
         if self.server:
             self.server.stop()
             self.server = None
             
+class TabNetGame(TabGame):
+    # a game hosted by the server, color is None when only watching
+    def __init__(self, parent, tab_server, game_id, white, black, color, moves=()):
+        super().__init__(parent, white+' vs '+black)
+
+        self.tab_server = tab_server
+        self.game_id = game_id
+        self.color = color
+        self.waiting = False
+        self.result = None
+
+        self.board = chess.Board()
+        for uci in moves:
+            self.append_san(chess.Move.from_uci(uci))
+            self.board.push_uci(uci)
+        self.boardWidget.addMoveListener(self)
+        self.boardWidget.setBoard(self.board, color == chess.BLACK)
+        self.update_can_move()
+
+        self.timer = QTime()
+        self.timer.start()
+
+    def elapsed(self):
+        return self.timer.elapsed()
+
+    def get_last_move(self):
+        return self.board.peek() if self.board.move_stack else None
+
+    def update_can_move(self):
+        self.can_move = self.result is None and not self.waiting and self.board.turn == self.color
+
+    def userMoved(self, uci_move):
+        if not self.can_move:
+            return
+        move = chess.Move.from_uci(uci_move)
+        if move not in self.board.legal_moves:
+            # promote to a queen when a pawn is dragged to the last rank
+            move = chess.Move.from_uci(uci_move+'q')
+            if move not in self.board.legal_moves:
+                return
+        # the server echoes the move back once it has checked it
+        self.waiting = True
+        self.update_can_move()
+        self.tab_server.client.move(self.game_id, move.uci())
+
+    def remote_move(self, uci):
+        move = chess.Move.from_uci(uci)
+        self.append_san(move)
+        self.board.push(move)
+        self.waiting = False
+        self.update_can_move()
+        self.boardWidget.update()
+        self.parent.game_state_changed(self)
+        self.timer.restart()
+
+    def game_over(self, result):
+        self.result = result
+        self.update_can_move()
+        self.parent.add_message('Game '+self.game_id+' over: '+result)
+
+    def closing(self):
+        self.tab_server.game_closed(self.game_id)
+
 class CoordLearn(TabGame):
     def __init__(self, parent, caption, gametype, color):
         super().__init__(parent, caption)
@@ -155,15 +358,37 @@ class QGame(TabGame):
     # widget type
     # SHADOW = range(2)
 
+    # the live analysis has a new line, emitted from an engine thread
+    analysisUpdated = pyqtSignal()
+    # score difference of a user move is ready, emitted from an engine thread with
+    # (board, user move, game move, future of the difference)
+    moveCompared = pyqtSignal(object, object, object, object)
+    # a live analysis ended by itself: failed, or nothing to search
+    analysisEnded = pyqtSignal(object)
+
     mouseMovePos = None
     offset_x = offset_y = 0
     winner = True
-    thread = None
     total_score = 0
 
     def __init__(self, parent, chess_game=None, caption = None):
         super().__init__(parent, caption)
 
+        # live analysis of the current position, started from Analyze
+        # only the newest engine update is kept and it is shown at most every ANALYSIS_INTERVAL ms
+        self.stream = None
+        self.stream_board = None
+        self.stream_info = None
+        self.stream_shown = 0
+        self.stream_scheduled = False
+        self.analysis_label = QLabel()
+        self.analysis_label.setWordWrap(True)
+        self.analysis_label.hide()
+        self.layout.addWidget(self.analysis_label)
+        self.analysisUpdated.connect(self.show_analysis)
+        self.analysisEnded.connect(self.analysis_ended)
+        self.moveCompared.connect(self.compare_moves)
+
         self.boardWidget.addMoveListener(self)
         if chess_game==None:
             chess_game = chess.pgn.Game()
@@ -176,6 +401,8 @@ class QGame(TabGame):
         self.node = chess_game
         self.board = chess_game.board()
         self.last_move = None
+        # book flag of every game move, checked in one pass
+        self.book_moves = self.parent.coach.book.game_moves(self.board, list(chess_game.mainline_moves()))
 
         result = chess_game.headers['Result']
         self.flip_board = False
@@ -250,34 +477,100 @@ class QGame(TabGame):
             
         move_text = self.board.san(move)
         self.parent.add_message('Your move: '+move_text+', Game move: '+self.board.san(game_move))
-        is_book_move = self.parent.is_book_move(self.board, move)
+        ply = len(self.board.move_stack)
+        is_book_move = self.book_moves[ply] if move == game_move and ply < len(self.book_moves) else None
+        is_book_move, opening_name, future = self.parent.coach.compare_move(self.board, move, game_move, is_book_move)
         if is_book_move:
-            opening_name = self.parent.get_opening_name(self.board)
-            self.parent.add_message(move_text+' (Book move '+opening_name+')')
-        if move!=game_move and not is_book_move:
+            self.parent.add_message(move_text+' (Book move '+('- '+opening_name if opening_name else '')+')')
+        if future:
             board_copy = self.board.copy()
-            self.thread = Thread(target=self.compare_moves, args=(board_copy, move, game_move))
-            self.thread.start()
+            future.add_done_callback(lambda f: self.moveCompared.emit(board_copy, move, game_move, f))
         self.make_move(game_move)
 
     def make_move(self, move):
         self.last_move = move
+        self.append_san(move)
         self.board.push(move)
         self.can_move = self.board.turn==self.winner if self.board_type == 2 else True
+        # the search of the old position is stopped, the analysis goes on with the new one
+        if self.stream:
+            self.start_analysis()
 
         self.parent.game_state_changed(self)
 
-    def compare_moves(self, board, user_move, game_move):
-        # evaluate move score
-        evaluation = self.parent.evaluate_moves(board, [user_move, game_move])
-        score_diff = evaluation[user_move] - evaluation[game_move]
-        self.parent.add_message('Move score ('+board.san(user_move)+' vs '+board.san(game_move)+'): '+ str(score_diff))
+    def start_analysis(self):
+        self.stop_analysis()
+        board = self.board.copy()
+        self.stream_board = board
+        stream = self.parent.coach.stream_board(board, lambda info: self.analysis_info(board, info))
+        self.stream = stream
+        self.analysis_label.setText('Analyzing...')
+        self.analysis_label.show()
+        stream.future.add_done_callback(lambda f: self.analysisEnded.emit(stream))
+
+    def stop_analysis(self):
+        if self.stream is None:
+            return
+        self.parent.coach.stop_stream(self.stream)
+        self.stream = None
+        self.stream_board = None
+        self.analysis_label.hide()
+
+    def analysis_ended(self, stream):
+        # a stopped or replaced stream has nothing to report
+        if stream is not self.stream:
+            return
+        future = stream.future
+        error = None if future.cancelled() else future.exception()
+        if error:
+            text = 'Analysis failed: ' + (str(error) or type(error).__name__)
+        elif not any(stream.board.legal_moves):
+            text = 'Analysis: no legal moves'
+        else:
+            text = 'Analysis ended ' + self.analysis_label.text()
+        self.stream = None
+        self.stream_board = None
+        self.analysis_label.hide()
+        self.parent.add_message(text)
+
+    def analysis_info(self, board, info):
+        # engine thread: updates of a stopped search are dropped, one signal is pending at most
+        if board is not self.stream_board:
+            return
+        self.stream_info = (board, info)
+        if not self.stream_scheduled:
+            self.stream_scheduled = True
+            self.analysisUpdated.emit()
+
+    def show_analysis(self):
+        wait = self.stream_shown + ANALYSIS_INTERVAL / 1000 - time.perf_counter()
+        if wait > 0:
+            QTimer.singleShot(int(wait * 1000) + 1, self.show_analysis)
+            return
+        self.stream_scheduled = False
+        board, info = self.stream_info
+        if board is not self.stream_board:
+            return
+        self.stream_shown = time.perf_counter()
+        self.analysis_label.setText(analysis_text(board, info))
+
+    def closing(self):
+        self.stop_analysis()
+
+    def compare_moves(self, board, user_move, game_move, future):
+        caption = 'Move score ('+board.san(user_move)+' vs '+board.san(game_move)+')'
+        try:
+            score_diff = future.result()
+        except Exception as ex:
+            self.parent.add_message(caption+' failed: '+(str(ex) or type(ex).__name__))
+            return
+        self.parent.add_message(caption+': '+ str(score_diff))
         self.total_score += score_diff
         self.parent.add_message('Game score: '+ str(self.total_score))
 
     def evaluate(self, board, move):
         # evaluate move score
-        evaluation = self.parent.evaluate_board(board)[0]
+        evaluation = self.parent.coach.evaluate_board(board)[0]
         self.parent.add_message('Position Evaluation ('+move+') '+str(evaluation))
 
     # process user move
@@ -302,14 +595,11 @@ class QGame(TabGame):
             else:
                 self.make_move(move)
                 
-class GameListItem(QListWidgetItem):
-    def __init__(self, pgn_offset, pgn_header, index=''):
-        welo = pgn_header['WhiteElo']
-        belo = pgn_header['BlackElo']
-        super().__init__((str(index) + '. ' if index!='' else '') + '[' + pgn_header['Result'] + '] ' + pgn_header['White'] + ' ' + welo + ' vs ' + pgn_header['Black'] + ' ' + belo)
-        self.offset = pgn_offset
-        self.header = pgn_header
-        self.index = index
+def analysis_text(board, info):
+    # 'depth 18  +0.35  1. e4 e5 2. Nf3 ...', the score from white's side
+    score = info['score'].white()
+    value = '#%d' % score.mate() if score.is_mate() else '%+.2f' % (score.score() / 100)
+    return 'depth %d  %s  %s' % (info.get('depth', 0), value, board.variation_san(info['pv'][:ANALYSIS_PV_MOVES]))
 
 class OpeningListItem(QListWidgetItem):
     def __init__(self, key, value, index=''):
@@ -317,13 +607,6 @@ class OpeningListItem(QListWidgetItem):
         self.key = key
         self.value = value
 
-class TacticsListItem(QListWidgetItem):
-    def __init__(self, pgn_offset, pgn_header, index=''):
-        super().__init__((str(index) + '. ' if index!='' else '') + '[' + pgn_header['Result'] + '] ' + pgn_header['White'] + ' vs ' + pgn_header['Black'])
-        self.offset = pgn_offset
-        self.header = pgn_header
-        self.index = index
-
 class CoordListItem(QListWidgetItem):
     # Caption, File/Rank/Position (0/1/2), White/Black/Both (0/1/2)
     def __init__(self, caption, gametype, color):
@@ -331,60 +614,146 @@ class CoordListItem(QListWidgetItem):
         self.gametype = gametype
         self.color = color
 
+# seconds to wait for a server to accept a join
+JOIN_TIMEOUT = 10
+
 # app dimension in pixels
 DEFAULT_WIDTH  = 1200
 DEFAULT_HEIGHT = 800
+
+# engine results kept between sessions (None to not persist)
+EVAL_CACHE_FILE = 'evalcache.json'
+
+QUERY_HINT = 'player:carlsen elo:2500-2800 eco:B20-B99 result:1-0 date:2010-2015 sort:-date'
+
+# startup budget in ms for --profile-startup, from the start of the process
+FIRST_PAINT_BUDGET = 500
+INTERACTIVE_BUDGET = 2000
+
+# start one engine in the background once the app is interactive
+ENGINE_WARMUP = True
+
+# live analysis: ms between two updates of the shown line, moves of the line shown
+ANALYSIS_INTERVAL = 100
+ANALYSIS_PV_MOVES = 10
+
+# with --instrument: histograms shown as p50/p95 in the status bar, and the file they are written to on exit
+STATUS_METRICS = ['paint', 'book.probe', 'engine.queue_wait', 'engine.search']
+INSTRUMENT_FILE = 'instrument.json'
     
 class App(QMainWindow):
-
-    def __init__(self):
+    # loaders run on background threads, the signals hand their results to the ui thread
+    gamesLoaded = pyqtSignal(str, object)
+    tacticsLoaded = pyqtSignal(str, object)
+    componentReady = pyqtSignal(str)
+    # name of a part that could not be loaded and the error
+    componentFailed = pyqtSignal(str, str)
+    # file name and future of a finished game review, from an engine thread
+    reviewDone = pyqtSignal(str, object)
+
+    def __init__(self, profile_startup=False):
         super().__init__()
         
-        self.openings = {}
-        
+        self.profile_startup = profile_startup
+        self.startup_times = {}
+        # parts still loading, the app is interactive once they are all ready
+        self.loading = {'games', 'tactics', 'book', 'openings', 'eval cache'}
+        # parts whose loader failed, the app goes on without them
+        self.failed = set()
+
+        # engines, book and openings; its books and openings are loaded below
+        self.coach = Coach()
+        # move statistics of the games database for the explorer
+        self.move_tree = None
+        self.games_index = self.games_headers = self.position_index = None
+        self.tactics_index = self.tactics_headers = None
+        # the game tab with a live analysis, one at a time
+        self.analysis_tab = None
+
+        self.gamesLoaded.connect(self.games_loaded)
+        self.tacticsLoaded.connect(self.tactics_loaded)
+        self.componentReady.connect(self.component_ready)
+        self.componentFailed.connect(self.component_failed)
+        self.reviewDone.connect(self.review_done)
+
         self.init_ui()
 
-        self.static_board = chess.Board()
-        self.add_message('initializing opening book...')
-        self.book = chess.polyglot.open_reader("book.bin")
+        self.timer = QTimer()
+        self.timer.timeout.connect(self.tick)
+        self.timer.start(200)
 
-        self.thread = Thread(target=self.init_openings)
-        self.thread.start()
+    def eventFilter(self, obj, event):
+        # everything else loads once the window has been painted
+        if event.type() == QEvent.Paint and 'first paint' not in self.startup_times:
+            self.startup_times['first paint'] = (time.perf_counter() - STARTED) * 1000
+            obj.removeEventFilter(self)
+            QTimer.singleShot(0, self.start_loading)
+        return False
 
-        self.add_message('initializing engine...')
-        self.engine = chess.engine.SimpleEngine.popen_uci("stockfish")
-        self.engine_busy = False
+    def start_loading(self):
+        self.statusBar().showMessage('Loading...')
+        self.populate_game_list_from_pgn('games.pgn')
+        self.populate_tactics_list_from_pgn('tactics.pgn')
+        Thread(target=self.load_components, daemon=True).start()
 
-        self.add_message('Ready')
+    def load_components(self):
+        # book, openings and eval cache, one after the other off the ui thread
+        self.load_component('book', self.coach.load_books)
+        # compiles ecoe.pgn first when it changed
+        self.load_component('openings', self.coach.openings.load)
+        self.load_component('eval cache', lambda: EVAL_CACHE_FILE and self.coach.eval_cache.load(EVAL_CACHE_FILE))
 
-        self.timer = QTimer()
-        self.timer.timeout.connect(self.tick)
-        self.timer.start(200)
+    def load_component(self, name, load):
+        # runs on a loader thread, a failure is reported instead of leaving the part loading forever
+        try:
+            load()
+        except Exception as ex:
+            traceback.print_exc()
+            self.componentFailed.emit(name, str(ex) or type(ex).__name__)
+        else:
+            self.componentReady.emit(name)
 
-    def init_openings(self):
-        opening_file = open("ecoe.pgn")
-        game = chess.pgn.read_game(opening_file)
-        while game is not None:
-            chess_board = game.board()
-            line = chess_board.variation_san(game.mainline_moves())
-            black_player_name = game.headers['Black']
-            name = (' (' + black_player_name + ')') if black_player_name != '?' else ''
-            self.openings[line] = (game.headers['White'] + name, game.mainline_moves())
-            game = chess.pgn.read_game(opening_file)
-        self.populate_opening_list()
-
-    def get_opening_name(self, board):
-        san = self.static_board.variation_san(board.move_stack)
-        if san in self.openings:
-            return '- '+self.openings[san][0]
-        return ''
-
-    def is_book_move(self, board, move):
-        return any(move==x.move for x in self.book.find_all(board))
+    def component_failed(self, name, error):
+        self.failed.add(name)
+        self.add_message('Could not load '+name+': '+error)
+        self.loaded(name)
+
+    def component_ready(self, name):
+        if name == 'openings':
+            self.populate_opening_list()
+        self.loaded(name)
+
+    def loaded(self, name):
+        if name not in self.loading:
+            return
+        self.loading.discard(name)
+        self.startup_times[name] = (time.perf_counter() - STARTED) * 1000
+        if self.loading:
+            self.statusBar().showMessage('Loading ' + ', '.join(sorted(self.loading)) + '...')
+            return
+
+        self.startup_times['interactive'] = (time.perf_counter() - STARTED) * 1000
+        self.statusBar().showMessage('Ready')
+        self.add_message('Ready')
+        if self.profile_startup:
+            self.print_startup_profile()
+        if ENGINE_WARMUP:
+            Thread(target=self.coach.engines.warm, daemon=True).start()
+
+    def print_startup_profile(self):
+        for name, ms in sorted(self.startup_times.items(), key=lambda item: item[1]):
+            print('[STARTUP] %-12s %7.1f ms' % (name, ms))
+        for name, budget in (('first paint', FIRST_PAINT_BUDGET), ('interactive', INTERACTIVE_BUDGET)):
+            if self.startup_times[name] > budget:
+                print('[STARTUP] %s over budget: %.1f ms > %d ms' % (name, self.startup_times[name], budget))
 
     def init_ui(self):
         self.statusBar()
-        self.statusBar().showMessage('Ready')
+        self.statusBar().showMessage('Loading...')
+        # hot path latencies, right of the clock and loading messages
+        self.metrics_label = QLabel()
+        if instrument.enabled:
+            self.statusBar().addPermanentWidget(self.metrics_label)
 
         mm = self.menuBar()
         fm = mm.addMenu('&File')
@@ -400,6 +769,18 @@ class App(QMainWindow):
         act = QAction("Analyze", self)
         act.triggered.connect(self.analyze)
         fm.addAction(act)
+
+        act = QAction("Review Game...", self)
+        act.triggered.connect(self.review_game)
+        fm.addAction(act)
+
+        act = QAction("Find Position", self)
+        act.triggered.connect(self.find_position)
+        fm.addAction(act)
+
+        act = QAction("All Games", self)
+        act.triggered.connect(self.show_all_games)
+        fm.addAction(act)
         
         mnuSever = mm.addMenu('&Server')
         
@@ -411,14 +792,24 @@ class App(QMainWindow):
         act.triggered.connect(self.joinServer)
         mnuSever.addAction(act)
 
-        self.games_list = QListWidget()
-        self.games_list.itemDoubleClicked.connect(self.on_list_dbl_click)
+        self.games_list = QListView()
+        self.games_list.setUniformItemSizes(True)
+        self.games_list.doubleClicked.connect(self.on_list_dbl_click)
+        self.games_query = QLineEdit()
+        self.games_query.setPlaceholderText(QUERY_HINT)
+        self.games_query.returnPressed.connect(self.filter_games)
+        self.games_tab = self.query_tab(self.games_query, self.games_list)
 
         self.opening_list = QListWidget()
         self.opening_list.itemDoubleClicked.connect(self.on_opening_list_dbl_click)
         
-        self.tactics_list = QListWidget()
-        self.tactics_list.itemDoubleClicked.connect(self.on_tactics_list_dbl_click)
+        self.tactics_list = QListView()
+        self.tactics_list.setUniformItemSizes(True)
+        self.tactics_list.doubleClicked.connect(self.on_tactics_list_dbl_click)
+        self.tactics_query = QLineEdit()
+        self.tactics_query.setPlaceholderText(QUERY_HINT)
+        self.tactics_query.returnPressed.connect(self.filter_tactics)
+        self.tactics_tab = self.query_tab(self.tactics_query, self.tactics_list)
 
         self.coord_learn = QListWidget()
         self.coord_learn.itemDoubleClicked.connect(self.on_coord_learn_dbl_click)
@@ -430,13 +821,11 @@ class App(QMainWindow):
         self.tabs.currentChanged.connect(self.tab_changed)
         self.tabs.tabCloseRequested.connect(self.close_tab)
 
-        self.tabs.addTab(self.games_list, "Games")
-        self.populate_game_list_from_pgn('games.pgn')
+        self.tabs.addTab(self.games_tab, "Games")
 
         self.tabs.addTab(self.opening_list, "Openings")
         
-        self.tabs.addTab(self.tactics_list, "Tactics")
-        self.populate_tactics_list_from_pgn('tactics.pgn')
+        self.tabs.addTab(self.tactics_tab, "Tactics")
 
         self.tabs.addTab(self.coord_learn, "Coordinates")
         self.populate_coord_learn_list()
@@ -460,6 +849,11 @@ class App(QMainWindow):
         self.moves_list.setWordWrap(True)
         moves_check_layout.addWidget(self.moves_list)
 
+        moves_check_layout.addWidget(QLabel('Explorer (double click to play)'))
+        self.explorer_list = QListWidget()
+        self.explorer_list.itemDoubleClicked.connect(self.on_explorer_dbl_click)
+        moves_check_layout.addWidget(self.explorer_list, 1)
+
         self.check_list = QListWidget()
         self.populate_check_list()
         moves_check_layout.addWidget(self.check_list, 2)
@@ -467,41 +861,105 @@ class App(QMainWindow):
         main_layout.addWidget(moves_check_widget)
 
         self.setCentralWidget(main_widget)
+        main_widget.installEventFilter(self)
 
         self.resize(DEFAULT_WIDTH, DEFAULT_HEIGHT)
         self.setWindowTitle('Chess Coach')
         self.show()
 
+    def query_tab(self, query, list_view):
+        # a game list with its query bar above it
+        widget = QWidget()
+        layout = QVBoxLayout(widget)
+        layout.setContentsMargins(0, 0, 0, 0)
+        layout.addWidget(query)
+        layout.addWidget(list_view)
+        return widget
+
     def tab_changed(self, index):
         tab = self.tabs.currentWidget()
-        if isinstance(tab, QGame):
+        if isinstance(tab, (QGame, TabNetGame)):
             self.game_state_changed(tab)
 
     def close_tab(self, index):
-        tab = self.tabs.currentWidget()
+        tab = self.tabs.widget(index)
         if isinstance(tab, TabEmpty):
             tab.closing()
             self.tabs.removeTab(index)
 
     def game_state_changed(self, qgame):
-        msg = self.static_board.variation_san(qgame.board.move_stack)
-        self.moves_list.setText(msg)
+        self.moves_list.setText(qgame.moves_text)
+        self.populate_explorer(qgame.board)
+
+    def populate_explorer(self, board):
+        # next moves of the games database and the book, read from the precomputed move tree
+        self.explorer_list.clear()
+        for move, games, score, elo, weight in explore(self.move_tree, self.coach.book, board):
+            text = board.san(move)
+            if games:
+                text += '  %d games  %.0f%%  %s' % (games, score, elo if elo else '-')
+            if weight:
+                text += '  book %.0f%%' % weight
+            item = QListWidgetItem(text)
+            item.setData(Qt.UserRole, move.uci())
+            self.explorer_list.addItem(item)
+
+    def on_explorer_dbl_click(self, item):
+        tab = self.tabs.currentWidget()
+        if isinstance(tab, (QGame, TabNetGame)) and tab.can_move:
+            tab.userMoved(item.data(Qt.UserRole))
 
     def analyze(self):
+        # starts or stops the live analysis of the current game tab, the last line goes to the messages
+        tab = self.tabs.currentWidget()
+        if not isinstance(tab, QGame):
+            return
+        if tab.stream:
+            self.add_message('... '+tab.analysis_label.text())
+            tab.stop_analysis()
+            return
+        if self.analysis_tab and self.analysis_tab is not tab:
+            self.analysis_tab.stop_analysis()
+        self.analysis_tab = tab
+        tab.start_analysis()
+
+    def review_game(self):
+        # score every move played in the current game tab and save it as an annotated pgn
         tab = self.tabs.currentWidget()
-        if isinstance(tab, QGame):
-            board_copy = tab.board.copy()
-            self.thread = Thread(target=self.analyze_board, args=(board_copy,))
-            self.thread.start()
-
-    def analyze_board(self, board):
-        self.eval_msg = QListWidgetItem('Analyzing Position...')
-        self.add_message(self.eval_msg)
-        msg = self.evaluate_board(board)
-        self.eval_msg = QListWidgetItem('... ('+str(msg[0])+') '+board.variation_san(msg[1]))
-        self.add_message(self.eval_msg)
+        if not isinstance(tab, QGame) or not tab.board.move_stack:
+            return
+        file_name, _ = QFileDialog.getSaveFileName(self, 'Save Review', 'review.pgn', 'PGN (*.pgn)')
+        if not file_name:
+            return
+        game = chess.pgn.Game.from_board(tab.board)
+        if tab.board_type == 2:
+            game.headers.update(tab.node.game().headers)
+        self.add_message('Reviewing '+str(len(tab.board.move_stack))+' moves...')
+        future = GameReview(game, self.coach.engine_submit).start()
+        future.add_done_callback(lambda f: self.reviewDone.emit(file_name, f))
+
+    def review_done(self, file_name, future):
+        try:
+            review = future.result()
+        except Exception as ex:
+            self.add_message('Review failed: '+(str(ex) or type(ex).__name__))
+            return
+        try:
+            with open(file_name, 'w') as f:
+                f.write(review.pgn() + '\n\n')
+        except OSError as ex:
+            self.add_message('Review not saved: '+str(ex))
+            return
+        self.add_message(review.summary(chess.WHITE))
+        self.add_message(review.summary(chess.BLACK))
+        self.add_message('Review saved to %s (%d positions, %.1f positions/s)' % (file_name, review.positions, review.positions_per_second()))
 
     def tick(self):
+        if instrument.enabled:
+            self.metrics_label.setText(instrument.status(STATUS_METRICS))
+        # the status bar says what is still loading until everything is ready
+        if self.loading:
+            return
         tab = self.tabs.currentWidget()
         try:
             elapsed = tab.elapsed() / 1000
@@ -545,47 +1003,140 @@ class App(QMainWindow):
         self.opening_list.clear()
         grouping = ''
         index = 1
-        for k, v in self.openings.items():
-            c = k[:6].strip()
+        for san, name, moves in self.coach.openings.lines():
+            c = san[:6].strip()
             if grouping != c:
                 grouping = c
                 self.opening_list.addItem('==== '+grouping+' ====')
             
-            opening = OpeningListItem(k, v, index)
+            opening = OpeningListItem(san, (name, moves), index)
             self.opening_list.addItem(opening)
             index += 1
             
     def populate_game_list_from_pgn(self, file_name):
+        # the index is read or built off the ui thread, the list is filled once it is loaded
+        Thread(target=self.load_pgn, args=(file_name, self.gamesLoaded, 'games'), daemon=True).start()
+
+    def load_pgn(self, file_name, loaded, name):
+        try:
+            self.coach.eval_store.load(file_name + STORE_SUFFIX)
+            pgn_index = PgnIndex(file_name).load()
+        except Exception as ex:
+            traceback.print_exc()
+            self.componentFailed.emit(name, str(ex) or type(ex).__name__)
+            return
+        loaded.emit(file_name, pgn_index)
+
+    def games_loaded(self, file_name, pgn_index):
         self.pgn_file = open(file_name)
-        self.games_list.clear()
-        index = 1
-        while True:
-            offset = self.pgn_file.tell()
-            header = chess.pgn.read_headers(self.pgn_file)
-            if header is None:
-                break
-            
-            game = GameListItem(offset, header, index)
-            self.games_list.addItem(game)
-            index += 1
-            
+        self.games_index = pgn_index
+        self.games_headers = self.load_headers(self.games_index)
+        self.games_model = GameListModel(self.games_index, game_list_text, self)
+        self.games_list.setModel(self.games_model)
+        self.games_query.clear()
+
+        self.position_index = PositionIndex(file_name)
+        if self.position_index.is_current():
+            self.position_index.load()
+        else:
+            # index the positions of a new or changed pgn in the background
+            Thread(target=self.position_index.load, args=(self.games_index,), daemon=True).start()
+
+        if self.move_tree:
+            self.move_tree.close()
+        self.move_tree = None
+        tree = MoveTree(file_name)
+        if tree.is_current():
+            self.move_tree = tree.load()
+        else:
+            # the explorer lists the book moves alone until the tree is built
+            Thread(target=self.load_move_tree, args=(tree,), daemon=True).start()
         self.update()
+        self.component_ready('games')
+
+    def load_move_tree(self, tree):
+        # built or extended off the ui thread, used once complete
+        self.move_tree = tree.load()
+
+    def find_position(self):
+        # list the games reaching the position of the current game tab
+        tab = self.tabs.currentWidget()
+        if not isinstance(tab, (QGame, TabNetGame)):
+            return
+        if not self.position_index or not self.position_index.map:
+            self.add_message('Position index is still being built')
+            return
+        started = time.perf_counter()
+        games = self.position_index.find_board(tab.board)
+        rows = sorted({bisect.bisect_left(self.games_index.offsets, offset) for offset, ply in games})
+        elapsed = (time.perf_counter() - started) * 1000
+
+        self.games_model = GameListModel(self.games_index, game_list_text, self, rows)
+        self.games_list.setModel(self.games_model)
+        self.tabs.setCurrentWidget(self.games_tab)
+        self.add_message('%d games reach this position (%.1f ms)' % (len(rows), elapsed))
+
+    def show_all_games(self):
+        if self.games_index is None:
+            return
+        self.games_model = GameListModel(self.games_index, game_list_text, self)
+        self.games_list.setModel(self.games_model)
+        self.games_query.clear()
+        self.tabs.setCurrentWidget(self.games_tab)
+
+    def load_headers(self, pgn_index):
+        # header store of a list, built in the background as a large database takes a while
+        future = Future()
+        def build():
+            try:
+                future.set_result(HeaderStore(pgn_index))
+            except Exception as ex:
+                future.set_exception(ex)
+        Thread(target=build, daemon=True).start()
+        return future
+
+    def query_headers(self, headers, text):
+        # (rows, ms) of the games matching text, rows None for all of them, None on errors
+        if headers is None or not headers.done():
+            self.add_message('Game headers are still being loaded')
+            return None
+        started = time.perf_counter()
+        try:
+            rows = headers.result().query(text)
+        except QueryError as ex:
+            self.add_message('Query: '+str(ex))
+            return None
+        return rows, (time.perf_counter() - started) * 1000
+
+    def filter_games(self):
+        result = self.query_headers(self.games_headers, self.games_query.text())
+        if result is None:
+            return
+        rows, elapsed = result
+        self.games_model = GameListModel(self.games_index, game_list_text, self, rows)
+        self.games_list.setModel(self.games_model)
+        self.add_message('%d games (%.1f ms)' % (len(self.games_model), elapsed))
+
+    def filter_tactics(self):
+        result = self.query_headers(self.tactics_headers, self.tactics_query.text())
+        if result is None:
+            return
+        rows, elapsed = result
+        self.tactics_model = GameListModel(self.tactics_index, tactics_list_text, self, rows)
+        self.tactics_list.setModel(self.tactics_model)
+        self.add_message('%d tactics (%.1f ms)' % (len(self.tactics_model), elapsed))
 
     def populate_tactics_list_from_pgn(self, file_name):
+        Thread(target=self.load_pgn, args=(file_name, self.tacticsLoaded, 'tactics'), daemon=True).start()
+
+    def tactics_loaded(self, file_name, pgn_index):
         self.tactics_file = open(file_name)
-        self.tactics_list.clear()
-        index = 1
-        while True:
-            offset = self.tactics_file.tell()
-            header = chess.pgn.read_headers(self.tactics_file)
-            if header is None:
-                break
-            
-            game = TacticsListItem(offset, header, index)
-            self.tactics_list.addItem(game)
-            index += 1
-            
+        self.tactics_index = pgn_index
+        self.tactics_headers = self.load_headers(self.tactics_index)
+        self.tactics_model = GameListModel(self.tactics_index, tactics_list_text, self)
+        self.tactics_list.setModel(self.tactics_model)
         self.update()
+        self.component_ready('tactics')
 
     def populate_coord_learn_list(self):
         self.coord_learn.addItem(CoordListItem('Rank (white)', 0, 0))
@@ -598,33 +1149,34 @@ class App(QMainWindow):
         self.update()
         
     # Game list Double Clicked
-    def on_list_dbl_click(self, selected_item):
-        self.pgn_file.seek(selected_item.offset)
-        selected_game = chess.pgn.read_game(self.pgn_file)
-        self.static_board = selected_game.board()
+    def on_list_dbl_click(self, model_index):
+        with instrument.timer('pgn.read'):
+            self.pgn_file.seek(self.games_model.offset(model_index.row()))
+            selected_game = chess.pgn.read_game(self.pgn_file)
         
-        tab_caption = selected_item.text()[:7]+'...'
-        self.tabs.addTab(QGame(self, selected_game, selected_item.text()), tab_caption)
+        text = model_index.data()
+        tab_caption = text[:7]+'...'
+        self.tabs.addTab(QGame(self, selected_game, text), tab_caption)
         # open the latest tab
         self.tabs.setCurrentIndex(self.tabs.count()-1)
-        self.add_message('Shadowing game: '+selected_item.text())
+        self.add_message('Shadowing game: '+text)
 
     # Tactics list Double Clicked
-    def on_tactics_list_dbl_click(self, selected_item):
-        self.tactics_file.seek(selected_item.offset)
-        selected_game = chess.pgn.read_game(self.tactics_file)
-        self.static_board = selected_game.board()
+    def on_tactics_list_dbl_click(self, model_index):
+        with instrument.timer('pgn.read'):
+            self.tactics_file.seek(self.tactics_model.offset(model_index.row()))
+            selected_game = chess.pgn.read_game(self.tactics_file)
         
-        tab_caption = selected_item.text()[:7]+'...'
-        self.tabs.addTab(QGame(self, selected_game, selected_item.text()), tab_caption)
+        text = model_index.data()
+        tab_caption = text[:7]+'...'
+        self.tabs.addTab(QGame(self, selected_game, text), tab_caption)
         # open the latest tab
         self.tabs.setCurrentIndex(self.tabs.count()-1)
-        self.add_message('Tactics: '+selected_item.text())
+        self.add_message('Tactics: '+text)
 
     # Opening list Double Clicked
     def on_opening_list_dbl_click(self, selected_item):
         selected_game = chess.pgn.Game()
-        self.static_board = selected_game.board()
         selected_game.add_line(selected_item.value[1])
         
         tab_caption = selected_item.text()[:7]+'...'
@@ -635,7 +1187,6 @@ class App(QMainWindow):
         
     # Opening list Double Clicked
     def on_coord_learn_dbl_click(self, selected_item):
-        self.static_board = None
         tab_caption = selected_item.text()
         self.tabs.addTab(CoordLearn(self, selected_item.text(), selected_item.gametype, selected_item.color), tab_caption)
         self.tabs.setCurrentIndex(self.tabs.count()-1)
@@ -645,42 +1196,30 @@ class App(QMainWindow):
         #self.msg_list.addItem(msg)
         self.msg_list.insertItem(0, msg)
 
-    def evaluate_board(self, board, time=1):
-        # evaluate move score
-        while self.engine_busy:
-            pass
-        self.engine_busy = True
-        info = self.engine.analyse(board, chess.engine.Limit(time=time))
-        self.engine_busy = False
-        return info['score'].relative.score(mate_score=100000), info['pv']
-
-    def evaluate_moves(self, board, moves_list):
-        # evaluate move score
-        while self.engine_busy:
-            pass
-            
-        moves_score = {}
-        self.engine_busy = True
-        
-        info = self.engine.analyse(board, chess.engine.Limit(time=1), multipv=len(moves_list), root_moves=moves_list)
-        for i in range(len(info)):
-            moves_score[info[i]['pv'][0]] = info[i]['score'].relative.score(mate_score=100000)
-            
-        self.engine_busy = False
-        return moves_score
-
     def closeEvent(self, e):
         print('... quitting!')
-        self.book.close()
-        self.engine.quit()
-
+        if self.position_index:
+            self.position_index.close()
+        if self.move_tree:
+            self.move_tree.close()
+        # a cache closed before it finished loading, or that failed to load, would overwrite the saved one
+        self.coach.close(EVAL_CACHE_FILE if 'eval cache' not in self.loading | self.failed else None)
+        if instrument.enabled:
+            instrument.dump(INSTRUMENT_FILE)
+            print('Instrumentation written to', INSTRUMENT_FILE)
+
+    # the networking modules are imported when a server is first created or joined
     def createServer(self):
+        from client import Client
+        from server import Server
+
         ip_port, do = QInputDialog.getText(self, 'Create Server', 'IP:Port', QLineEdit.Normal, 'localhost:5555')
         if do:
             ip, port = ip_port.split(':')
             
             print('Creating server', ip_port)
-            server = Server(ip, int(port))
+            # clients joining this server share our engines
+            server = Server(ip, int(port), analysis=self.coach.scheduler)
             res = server.connect()
             print(res[1])
             if res[0]:
@@ -701,6 +1240,8 @@ class App(QMainWindow):
         server.listen()
         
     def joinServer(self):
+        from client import Client
+
         ip_port, do = QInputDialog.getText(self, 'Join Server', 'IP:Port', QLineEdit.Normal, 'localhost:5555')
         if do:
             ip, port = ip_port.split(':')
@@ -711,15 +1252,37 @@ class App(QMainWindow):
                 print('Connecting as', username)
                 tab_caption = 'Joined @'+ip_port
                 tab = TabServer(self, tab_caption)
+                # the tab is added once the server has accepted the username
+                tab.joined.connect(lambda: self.server_joined(tab, tab_caption))
+                tab.rejected.connect(lambda reason: self.server_rejected(tab, reason))
                 tab.client = Client(ip, int(port), username, tab)
                 if tab.client.connected:
-                    self.tabs.addTab(tab, tab_caption)
-                    self.tabs.setCurrentIndex(self.tabs.count()-1)
+                    self.add_message('Joining '+ip_port+' as '+username+'...')
+                    QTimer.singleShot(int(JOIN_TIMEOUT * 1000), lambda: self.server_rejected(tab, 'no answer from the server'))
                 else:
                     print('Connection Failed!')
+                    self.add_message('Could not connect to '+ip_port)
+
+    def server_joined(self, tab, tab_caption):
+        if tab.client is None or tab.client in self.coach.remote_clients:
+            return
+        self.coach.remote_clients.append(tab.client)
+        self.tabs.addTab(tab, tab_caption)
+        self.tabs.setCurrentIndex(self.tabs.count()-1)
+
+    def server_rejected(self, tab, reason):
+        # a refused, closed or silent join; nothing once the tab has been added
+        if tab.client is None or tab.client.joined:
+            return
+        self.add_message('Could not join: '+reason)
+        tab.closing()
                     
 if __name__ == '__main__':
+    # --profile-startup prints time-to-first-paint and time-to-interactive
+    # --instrument records hot path latencies, shown in the status bar and written to INSTRUMENT_FILE
+    if '--instrument' in sys.argv:
+        instrument.enable()
     app = QApplication(sys.argv)
-    window = App()
+    window = App(profile_startup='--profile-startup' in sys.argv)
     sys.exit(app.exec_())
 
@@ -0,0 +1,206 @@
+# openingdb.py
+#
+# compiles ecoe.pgn into a binary opening database that is memory-mapped at startup
+#   python openingdb.py [ecoe.pgn] [ecoe.bin]
+
+import os
+import sys
+import mmap
+import struct
+
+import chess
+import chess.pgn
+import chess.polyglot
+
+DB_MAGIC = b'ECOB'
+DB_VERSION = 1
+
+# magic, version, source size, source mtime, line count, key count, section offsets
+HEADER = struct.Struct('<4sIQdIIIIIII')
+# name offset/length, san offset/length, moves offset/count
+LINE = struct.Struct('<IHIHIH')
+KEY = struct.Struct('<Q')
+KEY_LINE = struct.Struct('<I')
+MOVE = struct.Struct('<H')
+
+def pack_move(move):
+    return move.from_square | (move.to_square << 6) | ((move.promotion or 0) << 12)
+
+def unpack_move(value):
+    promotion = value >> 12
+    return chess.Move(value & 63, (value >> 6) & 63, promotion if promotion else None)
+
+def read_lines(pgn_name):
+    # (san, name, moves) for every line, later duplicates replace earlier ones like the old dict did
+    lines = {}
+    with open(pgn_name) as opening_file:
+        game = chess.pgn.read_game(opening_file)
+        while game is not None:
+            moves = list(game.mainline_moves())
+            line = game.board().variation_san(moves)
+            black_player_name = game.headers['Black']
+            name = (' (' + black_player_name + ')') if black_player_name != '?' else ''
+            lines[line] = (game.headers['White'] + name, moves)
+            game = chess.pgn.read_game(opening_file)
+    return [(san, name, moves) for san, (name, moves) in lines.items()]
+
+def build(pgn_name, db_name):
+    lines = read_lines(pgn_name)
+
+    # zobrist hash of every position along each line
+    line_keys = []
+    named = {}
+    for i, (san, name, moves) in enumerate(lines):
+        board = chess.Board()
+        keys = []
+        for move in moves:
+            board.push(move)
+            keys.append(chess.polyglot.zobrist_hash(board))
+        line_keys.append(keys)
+        if keys:
+            named[keys[-1]] = i
+
+    # positions inside a line take the deepest named position before them
+    positions = {}
+    for keys in line_keys:
+        line = None
+        for key in keys:
+            if key in named:
+                line = named[key]
+            elif line is not None:
+                positions.setdefault(key, line)
+    positions.update(named)
+    keys = sorted(positions)
+
+    strings = bytearray()
+    move_data = bytearray()
+    line_data = bytearray()
+    move_count = 0
+    for san, name, moves in lines:
+        name_bytes = name.encode('utf-8')
+        san_bytes = san.encode('utf-8')
+        line_data += LINE.pack(len(strings), len(name_bytes), len(strings) + len(name_bytes), len(san_bytes), move_count, len(moves))
+        strings += name_bytes + san_bytes
+        for move in moves:
+            move_data += MOVE.pack(pack_move(move))
+        move_count += len(moves)
+
+    key_data = b''.join(KEY.pack(k) for k in keys)
+    key_line_data = b''.join(KEY_LINE.pack(positions[k]) for k in keys)
+
+    keys_offset = HEADER.size
+    key_lines_offset = keys_offset + len(key_data)
+    lines_offset = key_lines_offset + len(key_line_data)
+    moves_offset = lines_offset + len(line_data)
+    strings_offset = moves_offset + len(move_data)
+
+    stat = os.stat(pgn_name)
+    header = HEADER.pack(DB_MAGIC, DB_VERSION, stat.st_size, stat.st_mtime, len(lines), len(keys),
+                         keys_offset, key_lines_offset, lines_offset, moves_offset, strings_offset)
+
+    temp_name = db_name + '.tmp'
+    with open(temp_name, 'wb') as f:
+        f.write(header)
+        f.write(key_data)
+        f.write(key_line_data)
+        f.write(line_data)
+        f.write(move_data)
+        f.write(strings)
+    os.replace(temp_name, db_name)
+    return len(lines), len(keys)
+
+class OpeningDB:
+    def __init__(self, pgn_name='ecoe.pgn', db_name=None):
+        self.pgn_name = pgn_name
+        self.db_name = db_name if db_name else os.path.splitext(pgn_name)[0] + '.bin'
+        self.file = None
+        self.map = None
+        self.line_count = 0
+        self.key_count = 0
+
+    def __len__(self):
+        return self.line_count
+
+    def read_header(self, data):
+        if len(data) < HEADER.size:
+            return None
+        header = HEADER.unpack_from(data, 0)
+        if header[0] != DB_MAGIC or header[1] != DB_VERSION:
+            return None
+        return header
+
+    def is_current(self):
+        # database exists and was compiled from the pgn as it is now
+        try:
+            stat = os.stat(self.pgn_name)
+            with open(self.db_name, 'rb') as f:
+                header = self.read_header(f.read(HEADER.size))
+        except OSError:
+            return False
+        return header is not None and header[2] == stat.st_size and header[3] == stat.st_mtime
+
+    def load(self):
+        # memory-map the database, compiling it first when missing or out of date
+        self.close()
+        if not self.is_current():
+            build(self.pgn_name, self.db_name)
+
+        self.file = open(self.db_name, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        header = self.read_header(self.map)
+        (_, _, _, _, self.line_count, self.key_count, self.keys_offset, self.key_lines_offset,
+         self.lines_offset, self.moves_offset, self.strings_offset) = header
+        return self
+
+    def close(self):
+        if self.map:
+            self.map.close()
+            self.map = None
+        if self.file:
+            self.file.close()
+            self.file = None
+        self.line_count = self.key_count = 0
+
+    def find(self, key):
+        # binary search over the sorted keys in the mapped file, returns the line index or None
+        lo, hi = 0, self.key_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if KEY.unpack_from(self.map, self.keys_offset + mid * KEY.size)[0] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.key_count and KEY.unpack_from(self.map, self.keys_offset + lo * KEY.size)[0] == key:
+            return KEY_LINE.unpack_from(self.map, self.key_lines_offset + lo * KEY_LINE.size)[0]
+        return None
+
+    def string(self, offset, length):
+        start = self.strings_offset + offset
+        return self.map[start:start + length].decode('utf-8')
+
+    def name(self, key):
+        if not self.map:
+            return None
+        i = self.find(key)
+        if i is None:
+            return None
+        name_offset, name_length, _, _, _, _ = LINE.unpack_from(self.map, self.lines_offset + i * LINE.size)
+        return self.string(name_offset, name_length)
+
+    def line(self, i):
+        # (san, name, moves) of line i
+        name_offset, name_length, san_offset, san_length, moves_offset, move_count = \
+            LINE.unpack_from(self.map, self.lines_offset + i * LINE.size)
+        start = self.moves_offset + moves_offset * MOVE.size
+        moves = [unpack_move(MOVE.unpack_from(self.map, start + j * MOVE.size)[0]) for j in range(move_count)]
+        return self.string(san_offset, san_length), self.string(name_offset, name_length), moves
+
+    def lines(self):
+        for i in range(self.line_count):
+            yield self.line(i)
+
+if __name__ == '__main__':
+    pgn_name = sys.argv[1] if len(sys.argv) > 1 else 'ecoe.pgn'
+    db_name = sys.argv[2] if len(sys.argv) > 2 else os.path.splitext(pgn_name)[0] + '.bin'
+    line_count, key_count = build(pgn_name, db_name)
+    print(db_name + ':', line_count, 'lines,', key_count, 'positions')
@@ -0,0 +1,136 @@
+# pgnindex.py
+
+import os
+import sys
+import json
+import hashlib
+
+from array import array
+
+import chess.pgn
+
+INDEX_VERSION = 1
+INDEX_SUFFIX = '.idx'
+
+# header fields kept in the index, enough to build the list items
+INDEX_TAGS = ['Event', 'Site', 'Date', 'Round', 'White', 'Black', 'Result', 'WhiteElo', 'BlackElo', 'ECO']
+
+HASH_CHUNK = 1 << 20
+
+def file_hash(file_name, size):
+    # blake2b over the first size bytes of the file
+    h = hashlib.blake2b(digest_size=16)
+    with open(file_name, 'rb') as f:
+        remaining = size
+        while remaining > 0:
+            chunk = f.read(min(HASH_CHUNK, remaining))
+            if not chunk:
+                break
+            h.update(chunk)
+            remaining -= len(chunk)
+    return h.hexdigest()
+
+def intern(value):
+    return sys.intern(value) if value is not None else None
+
+# sidecar index (<pgn>.idx) with the offset and header fields of every game
+# reused while the pgn is unchanged, extended when the pgn only grew
+class PgnIndex:
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.index_name = file_name + INDEX_SUFFIX
+        self.size = 0
+        self.mtime = 0
+        self.hash = None
+        self.offsets = array('q')
+        self.columns = {tag: [] for tag in INDEX_TAGS}
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def load(self):
+        # returns self, building or extending the index if needed
+        stat = os.stat(self.file_name)
+        if self.read_index():
+            if self.size == stat.st_size and self.mtime == stat.st_mtime:
+                return self
+            if self.size < stat.st_size and self.hash == file_hash(self.file_name, self.size):
+                self.scan(self.size)
+                self.write_index()
+                return self
+
+        self.offsets = array('q')
+        self.columns = {tag: [] for tag in INDEX_TAGS}
+        self.scan(0)
+        self.write_index()
+        return self
+
+    def read_index(self):
+        try:
+            with open(self.index_name) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return False
+
+        if data.get('version') != INDEX_VERSION or data.get('tags') != INDEX_TAGS:
+            return False
+
+        self.size = data['size']
+        self.mtime = data['mtime']
+        self.hash = data['hash']
+        self.offsets = array('q', data['offsets'])
+        # intern the repeated names/results so a large database shares them
+        self.columns = {tag: [intern(v) for v in data['columns'][tag]] for tag in INDEX_TAGS}
+        return True
+
+    def write_index(self):
+        data = {
+            'version': INDEX_VERSION,
+            'tags': INDEX_TAGS,
+            'size': self.size,
+            'mtime': self.mtime,
+            'hash': self.hash,
+            'offsets': self.offsets.tolist(),
+            'columns': self.columns,
+        }
+        try:
+            with open(self.index_name, 'w') as f:
+                json.dump(data, f, separators=(',', ':'))
+        except OSError as e:
+            print('[INDEX] could not write', self.index_name, e)
+
+    def scan(self, start):
+        # read headers from start to the end of the file
+        stat = os.stat(self.file_name)
+        with open(self.file_name) as pgn_file:
+            pgn_file.seek(start)
+            while True:
+                offset = pgn_file.tell()
+                header = chess.pgn.read_headers(pgn_file)
+                if header is None:
+                    break
+
+                self.offsets.append(offset)
+                for tag in INDEX_TAGS:
+                    self.columns[tag].append(intern(header.get(tag)))
+
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime
+        self.hash = file_hash(self.file_name, self.size)
+
+    def get(self, tag, i, default='?'):
+        value = self.columns[tag][i]
+        return default if value is None else value
+
+    def header(self, i):
+        header = chess.pgn.Headers()
+        for tag in INDEX_TAGS:
+            value = self.columns[tag][i]
+            if value is not None:
+                header[tag] = value
+        return header
+
+    def entries(self):
+        # (offset, header) for every game in file order
+        for i in range(len(self.offsets)):
+            yield self.offsets[i], self.header(i)
@@ -0,0 +1,184 @@
+# positionindex.py
+#
+# on-disk index from every position reached in a pgn to the games reaching it
+#   python positionindex.py games.pgn [--processes N]
+# the index (<pgn>.pos) is built in parallel over slices of the games and memory-mapped for lookups
+
+import os
+import sys
+import mmap
+import time
+import struct
+import argparse
+import multiprocessing
+
+import chess
+import chess.pgn
+import chess.polyglot
+
+from pgnindex import PgnIndex
+
+POS_MAGIC = b'POSI'
+POS_VERSION = 1
+POS_SUFFIX = '.pos'
+
+# magic, version, pgn size, pgn mtime, record count
+HEADER = struct.Struct('<4sIQdI')
+# position key, game offset, ply
+RECORD = struct.Struct('<QQH')
+
+# below this many games per process the start-up cost of a worker outweighs the work
+GAMES_PER_PROCESS = 500
+
+# collects the key of every mainline position, variations are skipped
+class PositionVisitor(chess.pgn.BaseVisitor):
+    def begin_game(self):
+        self.keys = {}
+        self.board = None
+
+    def visit_board(self, board):
+        self.board = board
+
+    def begin_variation(self):
+        return chess.pgn.SKIP
+
+    def visit_move(self, board, move):
+        # board is the reader's own board, still before move
+        self.board = board
+        self.keys.setdefault(chess.polyglot.zobrist_hash(board), len(board.move_stack))
+
+    def end_game(self):
+        # the reader has pushed the last move by now
+        if self.board is not None:
+            self.keys.setdefault(chess.polyglot.zobrist_hash(self.board), len(self.board.move_stack))
+
+    def result(self):
+        return self.keys
+
+def index_games(args):
+    # packed records for the games starting at offsets
+    pgn_name, offsets = args
+    records = bytearray()
+    with open(pgn_name) as pgn_file:
+        for offset in offsets:
+            pgn_file.seek(offset)
+            keys = chess.pgn.read_game(pgn_file, Visitor=PositionVisitor)
+            if keys is None:
+                continue
+            for key, ply in keys.items():
+                records += RECORD.pack(key, offset, min(ply, 0xffff))
+    return bytes(records)
+
+def build(pgn_index, pos_name, processes=None):
+    offsets = pgn_index.offsets.tolist()
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = max(1, min(processes, len(offsets) // GAMES_PER_PROCESS))
+
+    # contiguous slices keep each worker reading the file sequentially
+    step = (len(offsets) + processes - 1) // processes if offsets else 1
+    slices = [(pgn_index.file_name, offsets[i:i + step]) for i in range(0, len(offsets), step)]
+    if processes > 1:
+        # spawn, forking a process that runs qt threads is not safe
+        with multiprocessing.get_context('spawn').Pool(processes) as pool:
+            parts = pool.map(index_games, slices)
+    else:
+        parts = [index_games(part) for part in slices]
+
+    records = sorted(record for part in parts for record in RECORD.iter_unpack(part))
+
+    temp_name = pos_name + '.tmp'
+    with open(temp_name, 'wb') as f:
+        f.write(HEADER.pack(POS_MAGIC, POS_VERSION, pgn_index.size, pgn_index.mtime, len(records)))
+        f.write(b''.join(RECORD.pack(*record) for record in records))
+    os.replace(temp_name, pos_name)
+    return len(records)
+
+class PositionIndex:
+    def __init__(self, pgn_name):
+        self.pgn_name = pgn_name
+        self.pos_name = pgn_name + POS_SUFFIX
+        self.file = None
+        self.map = None
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def read_header(self, data):
+        if len(data) < HEADER.size:
+            return None
+        header = HEADER.unpack_from(data, 0)
+        if header[0] != POS_MAGIC or header[1] != POS_VERSION:
+            return None
+        return header
+
+    def is_current(self):
+        # index exists and was built from the pgn as it is now
+        try:
+            stat = os.stat(self.pgn_name)
+            with open(self.pos_name, 'rb') as f:
+                header = self.read_header(f.read(HEADER.size))
+        except OSError:
+            return False
+        return header is not None and header[2] == stat.st_size and header[3] == stat.st_mtime
+
+    def load(self, pgn_index=None, processes=None):
+        # memory-map the index, building it first when missing or out of date
+        self.close()
+        if not self.is_current():
+            build(pgn_index if pgn_index else PgnIndex(self.pgn_name).load(), self.pos_name, processes)
+
+        self.file = open(self.pos_name, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.count = self.read_header(self.map)[4]
+        return self
+
+    def close(self):
+        if self.map:
+            self.map.close()
+            self.map = None
+        if self.file:
+            self.file.close()
+            self.file = None
+        self.count = 0
+
+    def key(self, i):
+        return struct.unpack_from('<Q', self.map, HEADER.size + i * RECORD.size)[0]
+
+    def find(self, key):
+        # [(game offset, ply)] of every game reaching the position, in file order
+        if not self.map:
+            return []
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        games = []
+        while lo < self.count:
+            record_key, offset, ply = RECORD.unpack_from(self.map, HEADER.size + lo * RECORD.size)
+            if record_key != key:
+                break
+            games.append((offset, ply))
+            lo += 1
+        return games
+
+    def find_board(self, board):
+        return self.find(chess.polyglot.zobrist_hash(board))
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Build the position index of a pgn')
+    parser.add_argument('pgn')
+    parser.add_argument('--processes', type=int, help='worker processes (default: one per cpu)')
+    args = parser.parse_args(argv)
+
+    started = time.time()
+    pgn_index = PgnIndex(args.pgn).load()
+    count = build(pgn_index, args.pgn + POS_SUFFIX, args.processes)
+    print('%s: %d games, %d positions in %.2fs' % (args.pgn + POS_SUFFIX, len(pgn_index), count, time.time() - started))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,99 @@
+# protocol.py
+#
+# wire format shared by client and server
+#   frame:   4 byte big-endian payload length, payload
+#   payload: 1 byte message type, then string fields as 2 byte length + utf-8
+
+import struct
+
+import chess
+import chess.engine
+
+PROTOCOL_VERSION = 4
+
+# largest payload accepted, anything bigger is a broken or hostile peer
+MAX_FRAME = 1 << 20
+
+# message types, the index is the type byte on the wire
+# SNAPSHOT seq *users, JOIN seq user, LEAVE seq user, RESYNC asks for a new SNAPSHOT
+# CHALLENGE user, ACCEPT user, DECLINE user
+# START game white black, MOVE game uci [ply], GAME game white black *moves, WATCH game, END game result
+# WELCOME version analysis, ANALYZE id fen seconds priority multipv *root_moves, RESULT id *lines (no lines on failure)
+MESSAGES = ['HELLO', 'WELCOME', 'ERROR', 'NEW', 'SNAPSHOT', 'JOIN', 'LEAVE', 'RESYNC',
+            'CHALLENGE', 'ACCEPT', 'DECLINE', 'START', 'MOVE', 'GAME', 'WATCH', 'END',
+            'ANALYZE', 'RESULT']
+MESSAGE_TYPES = {name: i for i, name in enumerate(MESSAGES)}
+
+FRAME_HEADER = struct.Struct('>I')
+FIELD_HEADER = struct.Struct('>H')
+
+class ProtocolError(Exception):
+    pass
+
+def encode(cmd, *args):
+    payload = bytearray((MESSAGE_TYPES[cmd],))
+    for arg in args:
+        data = str(arg).encode('utf-8')
+        if len(data) > 0xffff:
+            raise ProtocolError('field too long')
+        payload += FIELD_HEADER.pack(len(data))
+        payload += data
+    if len(payload) > MAX_FRAME:
+        raise ProtocolError('message too long')
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+def decode_payload(payload):
+    if not payload or payload[0] >= len(MESSAGES):
+        raise ProtocolError('unknown message type')
+    args = []
+    offset = 1
+    while offset < len(payload):
+        if offset + FIELD_HEADER.size > len(payload):
+            raise ProtocolError('truncated field')
+        length = FIELD_HEADER.unpack_from(payload, offset)[0]
+        offset += FIELD_HEADER.size
+        if offset + length > len(payload):
+            raise ProtocolError('truncated field')
+        try:
+            args.append(payload[offset:offset + length].decode('utf-8'))
+        except UnicodeDecodeError:
+            raise ProtocolError('invalid utf-8 field')
+        offset += length
+    return MESSAGES[payload[0]], args
+
+# turns a stream of received chunks into messages, whatever way tcp split or joined them
+class FrameDecoder:
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        # returns the (cmd, args) of every message completed by data
+        self.buffer += data
+        messages = []
+        offset = 0
+        while len(self.buffer) - offset >= FRAME_HEADER.size:
+            length = FRAME_HEADER.unpack_from(self.buffer, offset)[0]
+            if length > MAX_FRAME:
+                raise ProtocolError('frame too long')
+            end = offset + FRAME_HEADER.size + length
+            if end > len(self.buffer):
+                break
+            messages.append(decode_payload(bytes(self.buffer[offset + FRAME_HEADER.size:end])))
+            offset = end
+        if offset:
+            del self.buffer[:offset]
+        return messages
+
+# an engine line as one field: depth, score for the side to move (#n for mates), pv moves
+def encode_line(info):
+    relative = info['score'].relative
+    score = '#' + str(relative.mate()) if relative.is_mate() else str(relative.score())
+    return ' '.join([str(info.get('depth', 0)), score] + [m.uci() for m in info.get('pv', ())])
+
+def decode_line(field, turn):
+    try:
+        depth, score, *pv = field.split()
+        score = chess.engine.Mate(int(score[1:])) if score.startswith('#') else chess.engine.Cp(int(score))
+        return {'depth': int(depth), 'score': chess.engine.PovScore(score, turn), 'pv': [chess.Move.from_uci(m) for m in pv]}
+    except ValueError:
+        raise ProtocolError('invalid engine line')
@@ -1,10 +1,14 @@
 
+import traceback
+
 import chess
 
-from PyQt5.QtCore import Qt
+from PyQt5.QtCore import Qt, QRect
 from PyQt5.QtWidgets import QWidget
 from PyQt5.QtGui import QPixmap, QPainter, QImage
 
+import instrument
+
 PIECE_IMAGE_INDEX = [0, 5, 3, 2, 4, 1, 0]
 
 show_ascii = False
@@ -21,6 +25,13 @@ class QBoard(QWidget):
         self.mousePressListeners = []
         self.moveListeners = []
         self.text = None
+        self.mouseMovePos = None
+
+        # piece pixmaps scaled to the current square size
+        self.piece_cache = {}
+        # board with every piece except the dragged one, rebuilt when its key changes
+        self.layer = None
+        self.layer_key = None
         
         if show_ascii:
             self.board_map = QPixmap('test.jpg')
@@ -44,57 +55,105 @@ class QBoard(QWidget):
         self.board = board
         self.flipped = flipped
         
+    def square_size(self):
+        return min(self.width(), self.height()) // 8
+
+    def square_rect(self, s, piece_size):
+        x = piece_size * ((7 - chess.square_file(s)) if self.flipped else chess.square_file(s))
+        y = piece_size * (chess.square_rank(s) if self.flipped else (7 - chess.square_rank(s)))
+        return QRect(x, y, piece_size, piece_size)
+
+    def drag_rect(self, piece_size):
+        # where the dragged piece is drawn
+        if self.from_square < 0 or not self.mouseMovePos:
+            return None
+        return QRect(int(self.mouseMovePos.x() - self.offset_x), int(self.mouseMovePos.y() - self.offset_y), piece_size, piece_size)
+
+    def dragging(self):
+        return self.from_square >= 0 and self.mouseMovePos is not None and self.board is not None and \
+            self.board.piece_at(self.from_square) is not None
+
+    def resizeEvent(self, e):
+        self.piece_cache = {}
+        self.layer = None
+        super().resizeEvent(e)
+
+    def piece_pixmap(self, piece, piece_size):
+        key = (piece.symbol(), piece_size)
+        pixmap = self.piece_cache.get(key)
+        if pixmap is None:
+            pixmap = QPixmap(piece_size, piece_size)
+            pixmap.fill(Qt.transparent)
+            painter = QPainter(pixmap)
+            # center images
+            if show_ascii:
+                font = painter.font()
+                font.setPixelSize(max(1, piece_size-4))
+                painter.setFont(font)
+                painter.drawText(0, 0, piece_size, piece_size, Qt.AlignCenter, piece.unicode_symbol())
+            else:
+                piece_index = PIECE_IMAGE_INDEX[piece.piece_type] + (0 if piece.color else 6)
+                img = self.piece_map[piece_index].scaled(piece_size, piece_size, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+                painter.drawImage((piece_size-img.width())//2, (piece_size-img.height())//2, img)
+            painter.end()
+            self.piece_cache[key] = pixmap
+        return pixmap
+
+    @instrument.timed('paint')
     def paintEvent(self, e):
+        piece_size = self.square_size()
+        if piece_size <= 0:
+            return
+
+        dragging = self.dragging()
+        last_move = self.game.get_last_move()
+        key = (piece_size, self.flipped, self.board.board_fen() if self.board else None, last_move,
+               self.from_square if dragging else -1, self.text)
+        if self.layer is None or key != self.layer_key:
+            self.layer = self.paint_layer(piece_size, last_move, self.from_square if dragging else -1)
+            self.layer_key = key
+
         painter = QPainter()
         painter.begin(self)
-        
-        board_size = min(self.width(), self.height())
-        piece_size = board_size/8
-        
-        font = painter.font()
-        font.setPixelSize(piece_size-4)
-        painter.setFont(font)
+        # only the dirty region is copied from the layer
+        painter.drawPixmap(e.rect(), self.layer, e.rect())
+        if dragging:
+            painter.drawPixmap(self.drag_rect(piece_size), self.piece_pixmap(self.board.piece_at(self.from_square), piece_size))
+        painter.end()
 
+    def paint_layer(self, piece_size, last_move, skip_square):
+        board_size = piece_size * 8
+        layer = QPixmap(self.width(), self.height())
+        layer.fill(self.palette().window().color())
+
+        painter = QPainter(layer)
         painter.drawPixmap(0, 0, board_size, board_size, self.board_map)
         if self.board:
-            self.paint_pieces(painter, self.board, self.flipped, piece_size)
-            
+            self.paint_pieces(painter, self.board, piece_size, last_move, skip_square)
+
         if self.text:
-            painter.drawText(board_size/2-65, board_size/2-65, 130, 130, Qt.AlignCenter, self.text)
-            
+            font = painter.font()
+            font.setPixelSize(max(1, piece_size-4))
+            painter.setFont(font)
+            painter.drawText(board_size//2-65, board_size//2-65, 130, 130, Qt.AlignCenter, self.text)
         painter.end()
-        
-    def paint_pieces(self, painter, board, flip, piece_size):
-        last_move = self.game.get_last_move()
-        
+        return layer
+
+    def paint_pieces(self, painter, board, piece_size, last_move, skip_square):
         for s in chess.SQUARES:
-            x = piece_size * ((7 - chess.square_file(s)) if flip else chess.square_file(s))
-            y = piece_size * (chess.square_rank(s) if flip else (7 - chess.square_rank(s)))
-            
+            rect = self.square_rect(s, piece_size)
+
             p = board.piece_at(s)
-            if p:
-                if s == self.from_square and self.mouseMovePos:
-                    x = self.mouseMovePos.x() - self.offset_x
-                    y = self.mouseMovePos.y() - self.offset_y
-                    
-                # center images
-                if show_ascii:
-                    sym = p.unicode_symbol()
-                    painter.drawText(x, y, piece_size, piece_size, Qt.AlignCenter, sym)
-                else:
-                    piece_index = PIECE_IMAGE_INDEX[p.piece_type] + (0 if p.color else 6)
-                    img = QImage.scaled(self.piece_map[piece_index], piece_size, piece_size, Qt.KeepAspectRatio)
-                    offset_x = (piece_size-img.width())/2
-                    offset_y = (piece_size-img.height())/2
-                    painter.drawImage(x+offset_x, y+offset_y, img)
-        
+            if p and s != skip_square:
+                painter.drawPixmap(rect, self.piece_pixmap(p, piece_size))
+
             if last_move and (last_move.from_square == s or last_move.to_square == s):
-                painter.drawRect(x, y, piece_size, piece_size)
-                        
+                painter.drawRect(rect)
+
     def mousePressEvent(self, e):
         if self.game.can_move:
             self.mouseMovePos = e.pos()
-            piece_size = min(self.width(), self.height())/8
+            piece_size = self.square_size()
 
             x = int(e.pos().x() / piece_size)
             self.offset_x = e.pos().x() - x * piece_size
@@ -113,14 +172,18 @@ class QBoard(QWidget):
         self.update()
 
     def mouseMoveEvent(self, e):
+        piece_size = self.square_size()
+        old_rect = self.drag_rect(piece_size)
         self.mouseMovePos = e.pos()
 
         super().mouseMoveEvent(e)
-        self.update()
+        if self.dragging():
+            # repaint only where the dragged piece was and is now
+            self.update(old_rect.united(self.drag_rect(piece_size)))
 
     def mouseReleaseEvent(self, e):
         if self.from_square >= 0:
-            piece_size = min(self.width(), self.height())/8
+            piece_size = self.square_size()
             x = int(e.pos().x() / piece_size)
             x = 7-x if self.flipped else x
             y = int(8 - (e.pos().y()) / piece_size)
@@ -143,4 +206,5 @@ class QBoard(QWidget):
 
     def setText(self, text = None):
         self.text = text
+        self.update()
         
\ No newline at end of file
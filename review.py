@@ -0,0 +1,207 @@
+# review.py
+#
+# post-mortem of a whole game: the positions are searched in game order, one at a time, and the
+# moves are classified by the score they lost
+#   python review.py games.pgn [--game N] [--engines N] [--time SECONDS] [--out FILE]
+# the result is the game annotated with [%eval] comments and ?!, ?, ?? nags
+
+import sys
+import time
+import argparse
+
+from concurrent.futures import Future
+
+import chess
+import chess.engine
+import chess.pgn
+
+from enginepool import EnginePool
+from scheduler import EngineScheduler, REVIEW
+from evaluation import MATE_SCORE
+
+# seconds of search per position
+REVIEW_TIME = 0.2
+
+# centipawns lost by a move to be called an inaccuracy, a mistake, a blunder
+INACCURACY = 50
+MISTAKE = 100
+BLUNDER = 300
+
+# scores are capped before they are compared, a won position stays won either way
+SCORE_CAP = 1000
+
+CLASSES = [(BLUNDER, 'Blunder', chess.pgn.NAG_BLUNDER),
+           (MISTAKE, 'Mistake', chess.pgn.NAG_MISTAKE),
+           (INACCURACY, 'Inaccuracy', chess.pgn.NAG_DUBIOUS_MOVE)]
+
+def capped(score):
+    return max(-SCORE_CAP, min(SCORE_CAP, score.relative.score(mate_score=MATE_SCORE)))
+
+def classify(loss):
+    # (name, nag) of a move losing loss centipawns, None for a good move
+    for threshold, name, nag in CLASSES:
+        if loss >= threshold:
+            return name, nag
+    return None
+
+class GameReview:
+    def __init__(self, game, submit, limit=chess.engine.Limit(time=REVIEW_TIME), priority=REVIEW):
+        # submit(board, limit, priority) returns a future of the engine info, e.g. EngineScheduler.submit
+        self.game = game
+        self.submit = submit
+        self.limit = limit
+        self.priority = priority
+
+        # the position before every move and the final one
+        self.moves = list(game.mainline_moves())
+        self.boards = []
+        board = game.board()
+        for move in self.moves:
+            self.boards.append(board.copy(stack=False))
+            board.push(move)
+        self.boards.append(board.copy(stack=False))
+
+        self.scores = [None] * len(self.boards)
+        self.pvs = [None] * len(self.boards)
+        self.depths = [None] * len(self.boards)
+        self.losses = []
+        self.counts = {chess.WHITE: {}, chess.BLACK: {}}
+        self.annotated = None
+        self.positions = 0
+        self.elapsed = 0
+
+    def start(self):
+        # future of self once every position is scored and the game annotated
+        self.future = Future()
+        self.started = time.perf_counter()
+        pending = []
+        for i, board in enumerate(self.boards):
+            if board.is_game_over():
+                # no search for a finished game, mated or drawn
+                self.scores[i] = chess.engine.PovScore(chess.engine.Mate(0) if board.is_checkmate() else chess.engine.Cp(0), board.turn)
+                self.pvs[i] = []
+            else:
+                pending.append(i)
+        self.positions = len(pending)
+        # one position in flight: the pool hands the engine that searched ply N back out for ply N+1,
+        # which finds its hash filled with the same lines; coaching requests still run in between
+        self.pending = pending
+        self.next()
+        return self.future
+
+    def next(self):
+        # positions answered at once, e.g. from the eval cache, are taken in a loop
+        while self.pending:
+            i = self.pending.pop(0)
+            future = self.submit(self.boards[i], self.limit, self.priority)
+            if not future.done():
+                future.add_done_callback(lambda f: self.scored(i, f))
+                return
+            if not self.store(i, future):
+                return
+        self.finish()
+
+    def scored(self, i, future):
+        if self.store(i, future):
+            self.next()
+
+    def store(self, i, future):
+        # False when the search failed, the review fails with it
+        try:
+            info = future.result()
+        except Exception as e:
+            if not self.future.done():
+                self.future.set_exception(e)
+            return False
+        self.scores[i] = info['score']
+        self.pvs[i] = info.get('pv', [])
+        self.depths[i] = info.get('depth')
+        return True
+
+    def finish(self):
+        self.elapsed = time.perf_counter() - self.started
+        try:
+            self.annotate()
+        except Exception as e:
+            self.future.set_exception(e)
+            return
+        self.future.set_result(self)
+
+    def positions_per_second(self):
+        return self.positions / self.elapsed if self.elapsed else 0
+
+    def annotate(self):
+        # each score is used twice: after the move that reached the position and before the next one
+        game = chess.pgn.Game()
+        game.headers.update(self.game.headers)
+        game.set_eval(self.scores[0], self.depths[0])
+        node = game
+        for i, move in enumerate(self.moves):
+            board = self.boards[i]
+            # both from the side making the move
+            loss = capped(self.scores[i]) + capped(self.scores[i + 1])
+            self.losses.append(max(0, loss))
+
+            node = node.add_variation(move)
+            found = classify(loss)
+            if found:
+                name, nag = found
+                counts = self.counts[board.turn]
+                counts[name] = counts.get(name, 0) + 1
+                node.nags.add(nag)
+                best = self.pvs[i][0] if self.pvs[i] else None
+                node.comment = name + ('. ' + board.san(best) + ' was best.' if best and best != move else '.')
+            node.set_eval(self.scores[i + 1], self.depths[i + 1])
+        self.annotated = game
+
+    def average_loss(self, color):
+        # average centipawn loss of color's moves
+        losses = [loss for i, loss in enumerate(self.losses) if self.boards[i].turn == color]
+        return sum(losses) / len(losses) if losses else 0
+
+    def summary(self, color):
+        counts = self.counts[color]
+        return '%s: %d inaccuracies, %d mistakes, %d blunders, average loss %.0f' % (
+            'White' if color == chess.WHITE else 'Black', counts.get('Inaccuracy', 0), counts.get('Mistake', 0),
+            counts.get('Blunder', 0), self.average_loss(color))
+
+    def pgn(self):
+        return str(self.annotated)
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Review a game of a pgn with the engine')
+    parser.add_argument('pgn')
+    parser.add_argument('--game', type=int, default=1, help='number of the game in the pgn, from 1')
+    parser.add_argument('--out', help='file for the annotated game (default: print it)')
+    parser.add_argument('--engines', type=int, default=1, help='number of engine processes, a game is searched on one')
+    parser.add_argument('--time', type=float, default=REVIEW_TIME, help='seconds per position')
+    parser.add_argument('--engine', default='stockfish', help='uci engine command')
+    args = parser.parse_args(argv)
+
+    with open(args.pgn) as pgn_file:
+        for i in range(args.game - 1):
+            chess.pgn.skip_game(pgn_file)
+        game = chess.pgn.read_game(pgn_file)
+    if game is None:
+        print('[REVIEW] no game', args.game, 'in', args.pgn)
+        return
+
+    pool = EnginePool(args.engine, args.engines)
+    scheduler = EngineScheduler(pool)
+    try:
+        review = GameReview(game, scheduler.submit, chess.engine.Limit(time=args.time)).start().result()
+    finally:
+        scheduler.close()
+        pool.close()
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(review.pgn() + '\n\n')
+    else:
+        print(review.pgn())
+    print('[REVIEW]', review.summary(chess.WHITE))
+    print('[REVIEW]', review.summary(chess.BLACK))
+    print('[REVIEW] %d positions in %.2fs, %.1f positions/s' % (review.positions, review.elapsed, review.positions_per_second()))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,264 @@
+# scheduler.py
+
+import time
+import queue
+import itertools
+import threading
+
+from concurrent.futures import Future
+
+import chess.engine
+
+import instrument
+
+# request priorities, lower runs first
+INTERACTIVE = 0
+BACKGROUND = 10
+# batches of a whole game queued at once, so coaching requests are not stuck behind them
+REVIEW = 15
+# live analyses run only when nothing else waits and give their engine up to any other request
+STREAM = 20
+
+def limit_key(limit):
+    return (limit.time, limit.depth, limit.nodes, limit.mate)
+
+def then(future, fn):
+    # new future resolving to fn(result of future)
+    chained = Future()
+    def done(f):
+        try:
+            chained.set_result(fn(f.result()))
+        except Exception as e:
+            chained.set_exception(e)
+    future.add_done_callback(done)
+    return chained
+
+def fallback(future, submit):
+    # new future resolving like future, or like the future from submit() if it fails
+    chained = Future()
+    def relay(f):
+        try:
+            chained.set_result(f.result())
+        except Exception as e:
+            chained.set_exception(e)
+    def done(f):
+        if f.cancelled() or f.exception() is None:
+            relay(f)
+        else:
+            submit().add_done_callback(relay)
+    future.add_done_callback(done)
+    return chained
+
+class Request:
+    def __init__(self, key, board, limit, priority, multipv, root_moves, on_info=None):
+        self.key = key
+        self.board = board
+        self.limit = limit
+        self.priority = priority
+        self.multipv = multipv
+        self.root_moves = root_moves
+        self.future = Future()
+        self.analysis = None
+        self.started = False
+        self.preempted = False
+        self.retried = False
+        # set for a stream, called with every scored update until it is stopped
+        self.on_info = on_info
+        self.stopped = False
+        # when the request was last queued, for the queue wait histogram
+        self.queued = time.perf_counter()
+
+# runs engine requests from a priority queue on the engine pool
+# identical pending requests share one future, interactive requests stop a background search when all engines are busy
+# streams search without a limit until stopped, a preempted stream resumes once an engine is free
+# results are answered from and stored to the optional eval cache
+class EngineScheduler:
+    def __init__(self, pool, timeout=10, cache=None):
+        self.pool = pool
+        self.timeout = timeout
+        self.cache = cache
+        self.queue = queue.PriorityQueue()
+        self.pending = {}
+        self.running = []
+        self.lock = threading.Lock()
+        self.counter = itertools.count()
+
+        self.workers = []
+        for i in range(pool.size):
+            worker = threading.Thread(target=self.work, daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, board, limit, priority=BACKGROUND, multipv=None, root_moves=None):
+        root_moves = list(root_moves) if root_moves else None
+        if self.cache is not None:
+            lines = self.cache.get(board, limit, multipv, root_moves)
+            if lines:
+                instrument.count('engine.cache_hit')
+                future = Future()
+                future.set_result(lines[0] if multipv is None else lines)
+                return future
+
+        key = (board.fen(), limit_key(limit), multipv, tuple(sorted(m.uci() for m in root_moves)) if root_moves else None)
+        with self.lock:
+            request = self.pending.get(key)
+            if request:
+                if priority < request.priority and not request.started:
+                    # queue again at the higher priority, the old entry is skipped when popped
+                    request.priority = priority
+                    self.queue.put((priority, next(self.counter), request))
+                instrument.count('engine.shared')
+                return request.future
+
+            request = Request(key, board.copy(), limit, priority, multipv, root_moves)
+            self.pending[key] = request
+            self.queue.put((priority, next(self.counter), request))
+
+            if len(self.running) >= len(self.workers):
+                self.preempt(priority)
+        return request.future
+
+    def stream(self, board, on_info, multipv=None):
+        # infinite analysis of board, on_info(info) is called on an engine thread at every scored update
+        # with the merged info, or the list of lines for multipv; returns the stream to pass to stop
+        with self.lock:
+            key = ('stream', next(self.counter))
+            request = Request(key, board.copy(), None, STREAM, multipv, None, on_info)
+            self.pending[key] = request
+            self.queue.put((STREAM, next(self.counter), request))
+        return request
+
+    def stop(self, request):
+        # ends a stream, its future resolves to the last info
+        with self.lock:
+            request.stopped = True
+            if request.analysis:
+                request.analysis.stop()
+            elif not request.started:
+                # still queued, the worker skips it
+                if self.pending.get(request.key) is request:
+                    del self.pending[request.key]
+                if not request.future.cancel() and not request.future.done():
+                    request.future.set_result(None)
+
+    def preempt(self, priority):
+        # stop the lowest priority running search that is below priority
+        victims = [r for r in self.running if r.priority > priority and r.analysis and not r.preempted]
+        if victims:
+            victim = max(victims, key=lambda r: r.priority)
+            victim.preempted = True
+            victim.analysis.stop()
+
+    def work(self):
+        while True:
+            _, _, request = self.queue.get()
+            if request is None:
+                break
+
+            with self.lock:
+                if request.started or request.future.done():
+                    continue
+                request.started = True
+                self.running.append(request)
+            # streams search until stopped and wait whenever preempted, they are timed apart
+            metric = 'engine.' if request.on_info is None else 'stream.'
+            instrument.record(metric + 'queue_wait', (time.perf_counter() - request.queued) * 1000)
+
+            # a preempted request is already running when it comes back
+            if not request.future.running() and not request.future.set_running_or_notify_cancel():
+                self.finish(request)
+                continue
+
+            try:
+                with instrument.timer(metric + 'search'):
+                    result = self.run(request)
+            except chess.engine.EngineTerminatedError as e:
+                # the pool restarted the engine, try once more
+                if not request.retried:
+                    request.retried = True
+                    self.requeue(request)
+                    continue
+                request.future.set_exception(e)
+            except Exception as e:
+                request.future.set_exception(e)
+            else:
+                if request.preempted and not request.stopped:
+                    self.requeue(request)
+                    continue
+                if self.cache is not None and request.on_info is None:
+                    self.cache.put(request.board, request.limit, [result] if request.multipv is None else result,
+                                   request.multipv, request.root_moves)
+                request.future.set_result(result)
+            self.finish(request)
+
+    def run(self, request):
+        if request.on_info is not None:
+            return self.run_stream(request)
+        limit = request.limit
+        with self.pool.engine(self.timeout) as engine:
+            with engine.analysis(request.board, limit, multipv=request.multipv, root_moves=request.root_moves) as analysis:
+                request.analysis = analysis
+                watchdog = None
+                if limit.time is not None:
+                    # stop searches that overrun their time limit
+                    watchdog = threading.Timer(limit.time + self.timeout, analysis.stop)
+                    watchdog.daemon = True
+                    watchdog.start()
+                try:
+                    analysis.wait()
+                finally:
+                    request.analysis = None
+                    if watchdog:
+                        watchdog.cancel()
+                if request.multipv is None:
+                    return analysis.info
+                return analysis.multipv
+
+    def run_stream(self, request):
+        with self.pool.engine(self.timeout) as engine:
+            with engine.analysis(request.board, multipv=request.multipv) as analysis:
+                with self.lock:
+                    request.analysis = analysis
+                    if request.stopped or request.preempted:
+                        analysis.stop()
+                try:
+                    for info in analysis:
+                        if 'score' in info and 'pv' in info:
+                            # copies, the engine thread keeps updating the originals
+                            if request.multipv is None:
+                                request.on_info(dict(analysis.info))
+                            else:
+                                request.on_info([dict(line) for line in analysis.multipv])
+                finally:
+                    request.analysis = None
+                if request.multipv is None:
+                    return dict(analysis.info)
+                return [dict(line) for line in analysis.multipv]
+
+    def requeue(self, request):
+        with self.lock:
+            request.started = False
+            request.preempted = False
+            request.queued = time.perf_counter()
+            if request in self.running:
+                self.running.remove(request)
+            self.queue.put((request.priority, next(self.counter), request))
+
+    def finish(self, request):
+        with self.lock:
+            if request in self.running:
+                self.running.remove(request)
+            if self.pending.get(request.key) is request:
+                del self.pending[request.key]
+
+    def close(self):
+        with self.lock:
+            for request in self.pending.values():
+                request.stopped = True
+                if request.analysis:
+                    request.analysis.stop()
+                request.future.cancel()
+            self.pending = {}
+        for worker in self.workers:
+            # sentinels sort after every real request
+            self.queue.put((float('inf'), next(self.counter), None))
@@ -1,75 +1,354 @@
 # server.py
 
-import socket
-from _thread import *
 import sys
+import socket
+import asyncio
+import argparse
+import itertools
+
+import chess
+import chess.engine
+
+from protocol import PROTOCOL_VERSION, ProtocolError, FrameDecoder, encode, encode_line
+from scheduler import INTERACTIVE, BACKGROUND
 
+# pending connections the os keeps for us
+BACKLOG = 1024
+# bytes buffered for a client before it is dropped as too slow
+CLIENT_BUFFER_LIMIT = 1 << 20
+# analysis requests a client may have outstanding, and the longest search it may ask for
+MAX_CLIENT_ANALYSES = 64
+MAX_ANALYSIS_TIME = 10
+# lines a client may ask for in one analysis
+MAX_MULTIPV = 5
+
+class ClientConnection:
+    def __init__(self, server, reader, writer):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.username = None
+        self.version = None
+        # clients this one has challenged, games it plays or watches
+        self.challenges = set()
+        self.watching = set()
+        # ids of analysis requests not answered yet
+        self.analyses = set()
+        self.closed = False
+
+    def send(self, msg):
+        # never blocks, the transport buffers and a client that can't keep up is disconnected
+        if self.closed or self.writer.transport.is_closing():
+            return
+        try:
+            self.writer.write(msg)
+        except (ConnectionError, OSError):
+            self.close()
+            return
+        if self.writer.transport.get_write_buffer_size() > CLIENT_BUFFER_LIMIT:
+            print('[SERVER]', self.username, 'too slow, disconnecting')
+            self.close()
+
+    def close(self, flush=False):
+        # drop the connection, after what is buffered when flush is set
+        if self.closed:
+            return
+        self.closed = True
+        if flush:
+            self.writer.close()
+        else:
+            self.writer.transport.abort()
+
+# a game hosted by the server, moves are checked against its own board
+class ServerGame:
+    def __init__(self, game_id, white, black):
+        self.id = game_id
+        self.white = white
+        self.black = black
+        self.board = chess.Board()
+        self.spectators = set()
+
+    def player(self, color):
+        return self.white if color == chess.WHITE else self.black
+
+    def watchers(self):
+        return [self.white, self.black] + list(self.spectators)
+
+# analysis is an EngineScheduler shared by every client, None to not offer analysis
 class Server:
-    def __init__(self, ip, port):
+    def __init__(self, ip, port, verbose=True, analysis=None):
         self.ip = ip
         self.port = port
+        self.verbose = verbose
+        self.analysis = analysis
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        
-        self.users = []
-        self.clients = []
-        
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+        # connected clients in join order
+        self.clients = {}
+        # bumped on every join/leave so clients can spot a missed delta
+        self.presence_seq = 0
+        self.by_name = {}
+
+        self.games = {}
+        self.game_ids = itertools.count(1)
+
         self.running = True
-        
+        self.loop = None
+        self.stopped = None
+
+    @property
+    def users(self):
+        return [c.username for c in self.clients if c.username is not None]
+
     def connect(self):
         try:
             self.socket.bind((self.ip, self.port))
         except socket.error as e:
             return False, str(e)
-        
+
         return True, 'Connected'
-    
+
     def listen(self):
-        self.socket.listen(2)
+        # runs the event loop until stop() is called
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        if not self.running:
+            return
+        server = await asyncio.start_server(self.handle_client, sock=self.socket, backlog=BACKLOG)
         print('[SERVER] listening...')
-        while self.running:
-            conn, addr = self.socket.accept()
-            self.clients.append(conn)
-            print("[SERVER] Connected to:", addr)
-
-            start_new_thread(self.threaded_client, (conn,))
-    
-    def broadcastUserList(self):
-        self.sendToAll(str.encode('USERS|'+str(self.users)))
-        
+        async with server:
+            await self.stopped.wait()
+
+        for client in list(self.clients):
+            client.close()
+        await asyncio.sleep(0)
+        print('[SERVER] stopped')
+
+    def sendSnapshot(self, client):
+        client.send(encode('SNAPSHOT', self.presence_seq, *self.users))
+
+    def broadcastPresence(self, cmd, username):
+        self.presence_seq += 1
+        self.sendToAll(encode(cmd, self.presence_seq, username))
+
     def sendToAll(self, msg):
-        print("[SERVER-BROADCAST]>> ", msg)
-        for conn in self.clients:
-            conn.sendall(msg)
-        
+        if self.verbose:
+            print("[SERVER-BROADCAST]>> ", msg)
+        for client in list(self.clients):
+            client.send(msg)
+
     def stop(self):
-        #self.socket.shutdown()
         self.running = False
-        self.socket.close()
-        
-    def threaded_client(self, conn):
-        conn.sendall(str.encode("CONNECTED"))
-        reply = ""
-        while True:
-            try:
-                data = conn.recv(2048)
-                reply = data.decode("utf-8")
+        if self.loop and self.stopped:
+            self.loop.call_soon_threadsafe(self.stopped.set)
+        else:
+            self.socket.close()
 
+    def handle(self, client, cmd, args):
+        if not client.version:
+            # the first message must be a matching HELLO
+            if cmd != 'HELLO' or not args or args[0] != str(PROTOCOL_VERSION):
+                client.send(encode('ERROR', 'protocol version ' + str(PROTOCOL_VERSION) + ' required'))
+                client.close(True)
+                return
+            client.version = PROTOCOL_VERSION
+            client.send(encode('WELCOME', PROTOCOL_VERSION, 1 if self.analysis else 0))
+        elif cmd=='NEW' and args and client.username is None:
+            if args[0] in self.users:
+                client.send(encode('ERROR', 'username ' + args[0] + ' is taken'))
+                client.close(True)
+                return
+            client.username = args[0]
+            self.by_name[client.username] = client
+            self.broadcastPresence('JOIN', client.username)
+            self.sendSnapshot(client)
+            for game in self.games.values():
+                client.send(encode('START', game.id, game.white.username, game.black.username))
+        elif client.username is None:
+            return
+        elif cmd=='RESYNC':
+            self.sendSnapshot(client)
+        elif cmd=='ANALYZE' and len(args) >= 5:
+            self.analyze(client, args)
+        elif cmd=='MOVE' and len(args) >= 2:
+            self.move(client, args[0], args[1])
+        elif cmd=='CHALLENGE' and args:
+            opponent = self.by_name.get(args[0])
+            if opponent and opponent is not client:
+                client.challenges.add(opponent)
+                opponent.send(encode('CHALLENGE', client.username))
+        elif cmd=='ACCEPT' and args:
+            challenger = self.by_name.get(args[0])
+            if challenger and client in challenger.challenges:
+                challenger.challenges.discard(client)
+                self.start_game(challenger, client)
+        elif cmd=='DECLINE' and args:
+            challenger = self.by_name.get(args[0])
+            if challenger and client in challenger.challenges:
+                challenger.challenges.discard(client)
+                challenger.send(encode('DECLINE', client.username))
+        elif cmd=='WATCH' and args:
+            game = self.games.get(args[0])
+            if game:
+                game.spectators.add(client)
+                client.watching.add(game)
+                client.send(encode('GAME', game.id, game.white.username, game.black.username,
+                                   *[m.uci() for m in game.board.move_stack]))
+
+    def start_game(self, white, black):
+        game = ServerGame(str(next(self.game_ids)), white, black)
+        self.games[game.id] = game
+        white.watching.add(game)
+        black.watching.add(game)
+        # everyone learns about the game so they can watch it
+        self.sendToAll(encode('START', game.id, white.username, black.username))
+
+    def move(self, client, game_id, uci):
+        game = self.games.get(game_id)
+        if game is None or game.player(game.board.turn) is not client:
+            client.send(encode('ERROR', 'not your move in game ' + game_id))
+            return
+        try:
+            move = chess.Move.from_uci(uci)
+        except ValueError:
+            move = None
+        if move is None or move not in game.board.legal_moves:
+            client.send(encode('ERROR', 'illegal move ' + uci + ' in game ' + game_id))
+            return
+
+        game.board.push(move)
+        # encoded once, the same bytes go to the players and every spectator
+        msg = encode('MOVE', game.id, uci, len(game.board.move_stack))
+        for watcher in game.watchers():
+            watcher.send(msg)
+
+        if game.board.is_game_over():
+            self.end_game(game, game.board.result())
+
+    def end_game(self, game, result):
+        if self.games.pop(game.id, None) is None:
+            return
+        for watcher in game.watchers():
+            watcher.watching.discard(game)
+        self.sendToAll(encode('END', game.id, result))
+
+    def analyze(self, client, args):
+        request_id = args[0]
+        if self.analysis is None or len(client.analyses) >= MAX_CLIENT_ANALYSES:
+            client.send(encode('RESULT', request_id))
+            return
+        try:
+            board = chess.Board(args[1])
+            limit = chess.engine.Limit(time=min(max(float(args[2]), 0.01), MAX_ANALYSIS_TIME))
+            priority = INTERACTIVE if int(args[3]) <= INTERACTIVE else BACKGROUND
+            multipv = int(args[4]) if args[4] else None
+            if multipv is not None:
+                if multipv < 1:
+                    raise ValueError('multipv must be positive')
+                multipv = min(multipv, MAX_MULTIPV)
+            root_moves = [chess.Move.from_uci(m) for m in args[5:]] or None
+        except ValueError:
+            board = None
+        if (board is None or not board.is_valid() or board.is_game_over() or
+                (root_moves and any(m not in board.legal_moves for m in root_moves))):
+            client.send(encode('RESULT', request_id))
+            return
+
+        # the scheduler hands identical requests from any client the same future, answered once
+        client.analyses.add(request_id)
+        future = self.analysis.submit(board, limit, priority, multipv, root_moves)
+        future.add_done_callback(lambda f: self.call_soon(self.send_result, client, request_id, f))
+
+    def call_soon(self, fn, *args):
+        # run fn on the event loop from an engine thread, unless the server has stopped
+        try:
+            self.loop.call_soon_threadsafe(fn, *args)
+        except RuntimeError:
+            pass
+
+    def send_result(self, client, request_id, future):
+        client.analyses.discard(request_id)
+        try:
+            result = future.result()
+        except Exception as e:
+            if self.verbose:
+                print('[SERVER] analysis failed:', e)
+            client.send(encode('RESULT', request_id))
+            return
+        lines = result if isinstance(result, list) else [result]
+        client.send(encode('RESULT', request_id, *[encode_line(info) for info in lines if 'score' in info]))
+
+    async def handle_client(self, reader, writer):
+        client = ClientConnection(self, reader, writer)
+        self.clients[client] = None
+        if self.verbose:
+            print("[SERVER] Connected to:", writer.get_extra_info('peername'))
+        decoder = FrameDecoder()
+        try:
+            while not client.closed:
+                data = await reader.read(65536)
                 if not data:
-                    print("Disconnected")
+                    if self.verbose:
+                        print("Disconnected")
                     break
-                else:
-                    print("[SERVER]<< ", reply)
-                    cmd, username = reply.split('|')
-                    if cmd=='NEW':
-                        self.users.append(username)
-                        self.broadcastUserList()
-            except Exception as e:
+
+                for cmd, args in decoder.feed(data):
+                    if self.verbose:
+                        print("[SERVER]<< ", cmd, args)
+                    self.handle(client, cmd, args)
+        except (ConnectionError, OSError, ProtocolError) as e:
+            if self.verbose:
                 print(e)
-                break
-
-        print('[SERVER]', username, 'teminated!')
-        self.clients.remove(conn)
-        self.users.remove(username)
-        self.broadcastUserList()
-        conn.close()
-        
\ No newline at end of file
+
+        if self.verbose:
+            print('[SERVER]', client.username, 'teminated!')
+        client.close(True)
+        self.clients.pop(client, None)
+        if client.username is not None and self.running:
+            self.by_name.pop(client.username, None)
+            for game in list(client.watching):
+                if client is game.white:
+                    self.end_game(game, '0-1')
+                elif client is game.black:
+                    self.end_game(game, '1-0')
+                else:
+                    game.spectators.discard(client)
+            self.broadcastPresence('LEAVE', client.username)
+
+def main(argv):
+    # a standalone server, optionally sharing engines with every client
+    parser = argparse.ArgumentParser(description='Chess Coach server')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=5555)
+    parser.add_argument('--engines', type=int, default=0, help='engine processes for shared analysis, 0 for none')
+    parser.add_argument('--engine', default='stockfish', help='uci engine command')
+    parser.add_argument('--cache-mb', type=int, default=256, help='shared eval cache size')
+    parser.add_argument('--quiet', action='store_true')
+    args = parser.parse_args(argv)
+
+    pool = scheduler = None
+    if args.engines:
+        from enginepool import EnginePool
+        from evalcache import EvalCache
+        from scheduler import EngineScheduler
+        pool = EnginePool(args.engine, args.engines, lazy=True)
+        scheduler = EngineScheduler(pool, cache=EvalCache(args.cache_mb << 20))
+
+    server = Server(args.host, args.port, not args.quiet, scheduler)
+    ok, msg = server.connect()
+    print(msg)
+    if ok:
+        try:
+            server.listen()
+        except KeyboardInterrupt:
+            pass
+    if scheduler:
+        scheduler.close()
+        pool.close()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
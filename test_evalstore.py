@@ -0,0 +1,71 @@
+# test_evalstore.py
+#
+#   python -m unittest test_evalstore
+
+import os
+import tempfile
+import unittest
+
+import chess
+
+from evalstore import EvalStore, HEADER
+
+E4 = chess.Move.from_uci('e2e4')
+D4 = chess.Move.from_uci('d2d4')
+
+class EvalStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.file_name = os.path.join(self.dir.name, 'games.pgn.evals')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def write(self, keys):
+        store = EvalStore().open(self.file_name)
+        for key in keys:
+            store.add(key, 20, {E4: key * 10, D4: key + 20})
+        store.close()
+
+    def read(self):
+        store = EvalStore()
+        end = store.load(self.file_name)
+        return store, end
+
+    def test_reopen_appends(self):
+        self.write([1, 2])
+        self.write([3])
+        store, end = self.read()
+        self.assertEqual(len(store), 3)
+        self.assertEqual(end, os.path.getsize(self.file_name))
+
+    def test_resume_after_interrupted_record(self):
+        self.write([1, 2])
+        # a run killed halfway through writing its next record
+        complete = os.path.getsize(self.file_name)
+        self.write([3])
+        os.truncate(self.file_name, complete + 5)
+
+        store, end = self.read()
+        self.assertEqual(end, complete)
+        self.assertEqual(len(store), 2)
+
+        self.write([3, 4])
+        store, end = self.read()
+        self.assertEqual(end, os.path.getsize(self.file_name))
+        self.assertEqual(sorted(store.positions), [1, 2, 3, 4])
+        for key in (1, 2, 3, 4):
+            depth, scores = store.positions[key]
+            self.assertEqual(sorted(scores.values()), sorted([key * 10, key + 20]))
+
+    def test_not_a_store(self):
+        with open(self.file_name, 'wb') as f:
+            f.write(b'junk' * 10)
+        self.assertEqual(self.read()[1], 0)
+        self.write([1])
+        store, end = self.read()
+        self.assertEqual(len(store), 1)
+        self.assertGreater(end, HEADER.size)
+
+if __name__ == '__main__':
+    unittest.main()